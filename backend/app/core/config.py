@@ -1,30 +1,57 @@
 import os
+from dataclasses import dataclass
 
+# Frozen: settings are read-only once the app is running.
+# (slots=True would need Python 3.10; the Docker image runs 3.9.)
+@dataclass(frozen=True)
 class Settings:
     PROJECT_NAME: str = "Proxy Geo Enhancer"
     API_V1_STR: str = "/api/v1" # 如果想版本化API
 
     # IP Geolocation API
-    IP_API_URL: str = "http://ip-api.com/json?fields=countryCode,country,query" # query是出口IP
+    IP_API_URL: str = "http://ip-api.com/json?fields=countryCode" # 只取国家代码，减少代理隧道上的传输
+    IP_API_BATCH_URL: str = "http://ip-api.com/batch?fields=countryCode,query" # 批量查询, 每次最多100个IP
+    IP_API_BATCH_SIZE: int = 100
+    IP_CHECK_TIMEOUT: float = 5.0 # 单次IP检测的总时限(秒)
+    PROXY_PREFLIGHT_TIMEOUT: float = 0.3 # 检测前对代理本身做TCP连通性探测的时限(秒)
+    # /api/check-ips: 单次请求最多检测的代理数, 以及全进程同时进行的检测数
+    IP_CHECK_MAX_PROXIES: int = 100
+    IP_CHECK_CONCURRENCY: int = 32
+    # 纯文本返回出口IP的轻量接口, 配合本地GeoIP库使用
+    EXIT_IP_URL: str = "http://api.ipify.org"
 
     # Paths for downloaded cores (relative to backend working directory)
     CORES_DIR: str = "downloaded_cores"
     CLASH_CORE_PATH: str = os.path.join(CORES_DIR, "mihomo")
     SINGBOX_CORE_PATH: str = os.path.join(CORES_DIR, "sing-box")
+    # Optional offline GeoIP database (GeoLite2-Country); lookups fall back to IP_API_URL without it
+    GEOIP_DB_PATH: str = os.environ.get("GEOIP_DB_PATH", os.path.join(CORES_DIR, "GeoLite2-Country.mmdb"))
 
 
     # GitHub API URLs for latest versions
     CLASH_META_LATEST_RELEASE_URL: str = "https://api.github.com/repos/MetaCubeX/Mihomo/releases/latest"
     SINGBOX_LATEST_RELEASE_URL: str = "https://api.github.com/repos/SagerNet/sing-box/releases/latest"
+    # 已有核心时多久(秒)向 GitHub 检查一次新版本; 0 = 从不检查 (有核心就直接用)
+    CORE_UPDATE_CHECK_INTERVAL: int = int(os.environ.get("CORE_UPDATE_CHECK_INTERVAL", "0"))
 
     # Temp config paths
     TEMP_DIR: str = "temp_configs"
-    TEMP_CLASH_CONFIG_PATH: str = os.path.join(TEMP_DIR, "temp_clash_config.yaml")
-    TEMP_SINGBOX_CONFIG_PATH: str = os.path.join(TEMP_DIR, "temp_singbox_config.json")
-    TEMP_PROXY_PORT: int = 10808 # 临时代理端口
+    # 测试核心的本地端口池 (入站端口和 external-controller 端口都从这里分配)
+    TEST_PORT_BASE: int = 10808
+    TEST_PORT_POOL_SIZE: int = 256
+    # Nodes tested in parallel on one core, each through its own inbound port
+    TEST_CONCURRENCY: int = int(os.environ.get("TEST_CONCURRENCY", "32"))
+    # Capture and log proxy core stdout/stderr (otherwise discarded)
+    DEBUG_CORE: bool = os.environ.get("DEBUG_CORE", "").lower() in ("1", "true", "yes")
+
+    # IP -> country lookup cache (persisted across restarts)
+    IP_CACHE_TTL: int = 86400 # 24h
+    IP_CACHE_MAXSIZE: int = 4096
+    IP_CACHE_PATH: str = os.path.join(TEMP_DIR, "ip_cache.json")
 
 settings = Settings()
 
 # Ensure temp_configs and downloaded_cores directories exist
-os.makedirs(settings.CORES_DIR, exist_ok=True)
-os.makedirs(settings.TEMP_DIR, exist_ok=True)
+for _dir in (settings.CORES_DIR, settings.TEMP_DIR):
+    if not os.path.isdir(_dir):
+        os.makedirs(_dir, exist_ok=True)
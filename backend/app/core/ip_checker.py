@@ -1,33 +1,317 @@
+import asyncio
+import functools
 import httpx
+import json
 import logging
+import os
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple, Union
+from cachetools import TTLCache
 from backend.app.core.config import settings
 
+try:
+    import maxminddb
+except ImportError: # Optional: without it every lookup goes to IP_API_URL
+    maxminddb = None
+
 logger = logging.getLogger(__name__)
 
-async def get_exit_ip_country(proxy_address: str): # proxy_address like "http://127.0.0.1:10808"
+# One pooled client per proxy address (None = direct), reused across checks so each
+# IP lookup rides an already-open keep-alive connection instead of a fresh TCP/TLS setup.
+_clients: Dict[Optional[str], httpx.AsyncClient] = {}
+
+def new_proxy_client(proxy_address: str) -> httpx.AsyncClient:
+    """
+    Creates a client that sends every request through proxy_address. The caller
+    owns it and must close it; _get_client keeps one of these per address.
+    """
+    # Route every scheme through a transport bound to the proxy. http://, https://
+    # and socks5:// proxy URLs are all handled by httpx itself (socks needs httpx[socks]).
+    # trust_env=False stops HTTP(S)_PROXY/NO_PROXY from silently overriding the proxy.
+    # The lookups are tiny plain-HTTP requests through a proxy, so HTTP/2 buys nothing:
+    # stay on HTTP/1.1 with keep-alive. verify=False only matters for https:// proxies.
+    transport = httpx.AsyncHTTPTransport(
+        proxy=proxy_address,
+        verify=False,
+        http1=True,
+        http2=False,
+        limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=30),
+    )
+    return httpx.AsyncClient(
+        mounts={"all://": transport},
+        trust_env=False,
+        timeout=httpx.Timeout(connect=2.0, read=3.0, write=2.0, pool=1.0),
+        headers={"Connection": "keep-alive"},
+    )
+
+def _get_client(proxy_address: Optional[str]) -> httpx.AsyncClient:
+    client = _clients.get(proxy_address)
+    if client is None or client.is_closed:
+        if proxy_address is None:
+            client = httpx.AsyncClient(timeout=15.0)
+        else:
+            client = new_proxy_client(proxy_address)
+        _clients[proxy_address] = client
+    return client
+
+# cache_key -> (country_code, checked_at). checked_at lets entries reloaded from disk
+# keep their original age instead of getting a fresh TTL.
+_country_cache = TTLCache(maxsize=settings.IP_CACHE_MAXSIZE, ttl=settings.IP_CACHE_TTL)
+# Results that describe the check rather than the exit IP, never cached
+_UNCACHEABLE_CODES = {"TO", "ER", "XX"}
+
+def load_cache(path: str = settings.IP_CACHE_PATH):
+    """Loads persisted lookups from disk, skipping entries older than the TTL."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.warning("Could not load IP cache from %s: %s", path, e)
+        return
+    if not isinstance(entries, dict):
+        logger.warning("Ignoring IP cache %s: not a JSON object", path)
+        return
+    now = time.time()
+    skipped = 0
+    for key, entry in entries.items():
+        # Valid JSON can still have the wrong shape (hand-edited, older format...): skip such entries
+        try:
+            country_code, checked_at = entry
+            fresh = isinstance(country_code, str) and now - checked_at < settings.IP_CACHE_TTL
+        except (TypeError, ValueError):
+            skipped += 1
+            continue
+        if fresh:
+            _country_cache[key] = (country_code, checked_at)
+    if skipped:
+        logger.warning("Skipped %s malformed entries in IP cache %s", skipped, path)
+    logger.info("Loaded %s cached IP lookups from %s", len(_country_cache), path)
+
+def save_cache(path: str = settings.IP_CACHE_PATH):
+    """Persists current lookups to disk."""
+    try:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(_country_cache.items()), f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning("Could not save IP cache to %s: %s", path, e)
+
+@functools.lru_cache(maxsize=None)
+def _get_geoip_reader():
+    """Opens the local GeoIP database once; None if unavailable."""
+    if maxminddb is None or not os.path.isfile(settings.GEOIP_DB_PATH):
+        return None
+    try:
+        reader = maxminddb.open_database(settings.GEOIP_DB_PATH, maxminddb.MODE_MMAP)
+    except Exception as e:
+        logger.warning("Could not open GeoIP database %s: %s", settings.GEOIP_DB_PATH, e)
+        return None
+    logger.info("Using local GeoIP database %s", settings.GEOIP_DB_PATH)
+    return reader
+
+def get_cached_country(cache_key: str) -> Optional[str]:
+    """Returns a cached country code for cache_key if it is still fresh."""
+    cached = _country_cache.get(cache_key)
+    if cached and time.time() - cached[1] < settings.IP_CACHE_TTL:
+        return cached[0]
+    return None
+
+def store_country(cache_key: str, country_code: str):
+    """Caches a lookup result for cache_key, unless it is a failure code."""
+    if country_code not in _UNCACHEABLE_CODES:
+        _country_cache[cache_key] = (country_code, time.time())
+
+async def close_clients():
+    """Closes all pooled clients. Called on application shutdown."""
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
+
+async def get_exit_ip_country(proxy_address: str, cache_key: Optional[str] = None, client: Optional[httpx.AsyncClient] = None): # proxy_address like "http://127.0.0.1:10808"
     """
     Fetches the exit IP's country by routing the request through the provided proxy.
+    If cache_key is given (something identifying the upstream node, not the local
+    proxy port that is reused between nodes), a recent result for it is returned
+    without any network call. client, if given, must already route through
+    proxy_address (see new_proxy_client); otherwise a pooled one is used.
     """
+    if cache_key is not None:
+        cached = get_cached_country(cache_key)
+        if cached:
+            return cached
+    country_code = await _check_exit_ip_country(proxy_address, client or _get_client(proxy_address))
+    if cache_key is not None:
+        store_country(cache_key, country_code)
+    return country_code
+
+async def get_exit_ip(proxy_address: str, client: Optional[httpx.AsyncClient] = None) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Fetches only the exit IP through the proxy (settings.EXIT_IP_URL), leaving
+    the country to lookup_countries so many IPs can be resolved in one batch.
+    Returns (ip, None), or (None, failure code) with get_exit_ip_country's codes.
+    client is as for get_exit_ip_country; callers pass one for a local core port
+    they already know is listening, so the TCP preflight is skipped then.
+    """
+    if client is None and not await _proxy_reachable(proxy_address):
+        return None, "ER" # Error
     try:
-        async with httpx.AsyncClient(proxies={"http://": proxy_address, "https://": proxy_address}, timeout=15.0, verify=False) as client:
-            # Using verify=False for simplicity with local proxies, ideally configure certs if needed
-            response = await client.get(settings.IP_API_URL)
-            response.raise_for_status()
-            data = response.json()
-            country_code = data.get("countryCode")
-            # country_name = data.get("country")
-            # actual_ip = data.get("query")
-            # logger.info(f"IP check via {proxy_address}: Country={country_code}, IP={actual_ip}")
-            if country_code:
-                return country_code.upper() # e.g., "US"
-            logger.warning(f"Country code not found in IP API response: {data}")
-            return "XX" # Unknown
+        client = client or _get_client(proxy_address)
+        response = await asyncio.wait_for(client.get(settings.EXIT_IP_URL), timeout=settings.IP_CHECK_TIMEOUT)
+        response.raise_for_status()
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        logger.error("Timeout when fetching exit IP via proxy %s", proxy_address)
+        return None, "TO" # Timeout
+    except httpx.HTTPError as e:
+        logger.error("Error fetching exit IP via proxy %s: %s", proxy_address, e)
+        return None, "ER" # Error
+    ip = response.text.strip()
+    return (ip, None) if ip else (None, "XX")
+
+_DEFAULT_PROXY_PORTS = {"http": 80, "https": 443, "socks5": 1080, "socks5h": 1080}
+
+@functools.lru_cache(maxsize=1024)
+def _proxy_endpoint(proxy_address: str) -> Tuple[Optional[str], Optional[int]]:
+    parts = urllib.parse.urlsplit(proxy_address)
+    return parts.hostname, parts.port or _DEFAULT_PROXY_PORTS.get(parts.scheme)
+
+async def _proxy_reachable(proxy_address: str) -> bool:
+    """Quick TCP connect to the proxy itself, so dead proxies fail in milliseconds."""
+    host, port = _proxy_endpoint(proxy_address)
+    if not host or not port:
+        return True # Let httpx report the malformed address
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=settings.PROXY_PREFLIGHT_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.error("Proxy %s is unreachable: %s %s", proxy_address, type(e).__name__, e)
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError: # e.g. reset by the proxy; it was reachable all the same
+        pass
+    return True
+
+async def _check_exit_ip_country(proxy_address: str, client: httpx.AsyncClient):
+    if not await _proxy_reachable(proxy_address):
+        return "ER" # Error
+    # Bound the whole check, not just each phase: a proxy that trickles bytes can
+    # otherwise keep resetting the per-read timeout and stall a batch of checks.
+    try:
+        return await asyncio.wait_for(_do_check(proxy_address, client), timeout=settings.IP_CHECK_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("IP check via proxy %s exceeded %ss", proxy_address, settings.IP_CHECK_TIMEOUT)
+        return "TO" # Timeout
+
+def _local_country(reader, ip: str) -> Optional[str]:
+    try:
+        record = reader.get(ip) or {}
+    except ValueError: # Not an IP address
+        return None
+    country_code = record.get("country", {}).get("iso_code")
+    return country_code.upper() if country_code else None
+
+async def _check_via_local_db(client: httpx.AsyncClient, reader) -> str:
+    # Only the bare exit IP travels through the proxy; the country comes from the local database
+    response = await client.get(settings.EXIT_IP_URL)
+    response.raise_for_status()
+    ip = response.text.strip()
+    country_code = _local_country(reader, ip)
+    if country_code:
+        return country_code
+    # Not in the local database: the IP is known now, so ask ip-api directly instead of via the proxy
+    return (await batch_country([ip])).get(ip, "XX")
+
+async def _do_check(proxy_address: str, client: httpx.AsyncClient):
+    try:
+        reader = _get_geoip_reader()
+        if reader is not None:
+            return await _check_via_local_db(client, reader)
+        response = await client.get(settings.IP_API_URL, headers={"Accept": "application/json"})
+        response.raise_for_status()
+        data = response.json()
+        country_code = data.get("countryCode")
+        if country_code:
+            return country_code.upper() # e.g., "US"
+        logger.warning("Country code not found in IP API response: %s", data)
+        return "XX" # Unknown
     except httpx.TimeoutException:
-        logger.error(f"Timeout when checking IP via proxy {proxy_address} for {settings.IP_API_URL}")
+        logger.error("Timeout when checking IP via proxy %s for %s", proxy_address, settings.IP_API_URL)
         return "TO" # Timeout
     except httpx.RequestError as e:
-        logger.error(f"Request error checking IP via proxy {proxy_address}: {e}")
+        logger.error("Request error checking IP via proxy %s: %s", proxy_address, e)
         return "ER" # Error
     except Exception as e:
-        logger.error(f"Unexpected error checking IP via proxy {proxy_address}: {type(e).__name__} - {e}", exc_info=True)
+        logger.error("Unexpected error checking IP via proxy %s: %s - %s", proxy_address, type(e).__name__, e, exc_info=True)
         return "XX" # Unknown / Exception
+
+# Bounds checks across all concurrent check_many calls, not just within one.
+# Created on first use, inside the loop.
+_check_sem: Optional[asyncio.Semaphore] = None
+
+async def check_many(addrs: List[str]) -> List[Union[str, BaseException]]:
+    """
+    Checks many proxies concurrently, at most settings.IP_CHECK_CONCURRENCY at a
+    time process-wide. Results are in the same order as addrs; a failed check
+    yields its exception.
+    """
+    global _check_sem
+    if _check_sem is None:
+        _check_sem = asyncio.Semaphore(settings.IP_CHECK_CONCURRENCY)
+
+    async def one(addr: str):
+        # Each address is its own upstream proxy here, so it doubles as the cache key
+        cached = get_cached_country(addr)
+        if cached:
+            return cached
+        async with _check_sem:
+            # addrs come from API callers, so don't pool a client per address in _clients
+            # (it would stay open until shutdown): use one just for this check
+            async with new_proxy_client(addr) as client:
+                return await get_exit_ip_country(addr, cache_key=addr, client=client)
+
+    return await asyncio.gather(*(one(a) for a in addrs), return_exceptions=True)
+
+async def batch_country(ips: List[str]) -> Dict[str, str]:
+    """
+    Resolves many already-known IPs to country codes with ip-api.com's batch
+    endpoint (up to IP_API_BATCH_SIZE per request) over a direct connection.
+    IPs whose chunk failed are missing from the result.
+    """
+    client = _get_client(None)
+    unique_ips = list(dict.fromkeys(ips))
+    countries = {}
+    for i in range(0, len(unique_ips), settings.IP_API_BATCH_SIZE):
+        chunk = unique_ips[i:i + settings.IP_API_BATCH_SIZE]
+        try:
+            response = await client.post(settings.IP_API_BATCH_URL, json=[{"query": ip} for ip in chunk])
+            response.raise_for_status()
+            for entry in response.json():
+                country_code = entry.get("countryCode")
+                countries[entry.get("query")] = country_code.upper() if country_code else "XX"
+        except Exception as e:
+            logger.error("Batch IP lookup of %s IPs failed: %s - %s", len(chunk), type(e).__name__, e)
+    return countries
+
+async def lookup_countries(ips: List[str]) -> Dict[str, str]:
+    """
+    Resolves exit IPs to country codes: from the local GeoIP database where
+    possible, the rest with batch_country. IPs that could not be resolved are
+    missing from the result.
+    """
+    reader = _get_geoip_reader()
+    countries = {}
+    remaining = []
+    for ip in dict.fromkeys(ips):
+        country_code = _local_country(reader, ip) if reader is not None else None
+        if country_code:
+            countries[ip] = country_code
+        else:
+            remaining.append(ip)
+    if remaining:
+        countries.update(await batch_country(remaining))
+    return countries
@@ -1,89 +1,257 @@
 import asyncio
+import httpx
 import os
+import urllib.parse
 import yaml
 import json
 import logging
+from typing import Dict, List, Optional, Sequence, Tuple
 from backend.app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
-async def run_proxy_core(core_path: str, config_path: str, core_type: str):
+# Output reader tasks started by monitor_process_output, keyed by PID, so
+# stop_proxy_core can cancel and join them.
+_monitor_tasks: Dict[int, List[asyncio.Task]] = {}
+
+# Core binaries already confirmed executable in this process
+_executable_checked = set()
+
+# Client for the cores' RESTful controller on localhost, reused across switches
+_controller_client: Optional[httpx.AsyncClient] = None
+
+# Free local ports for test cores (inbounds and controllers), shared by all batches
+# so concurrent requests never bind the same port. Created on first use, inside the loop.
+_free_ports: Optional[asyncio.Queue] = None
+_port_lock: Optional[asyncio.Lock] = None
+
+async def acquire_ports(count: int) -> List[int]:
     """
-    Starts the proxy core (Clash or Singbox) as a subprocess.
-    Returns the process object.
+    Takes count ports from the shared pool, waiting for other batches to
+    release theirs if the pool is short. Hand them back with release_ports.
     """
-    if not os.path.exists(core_path):
-        logger.error(f"{core_type} core not found at {core_path}")
-        raise FileNotFoundError(f"{core_type} core not found at {core_path}")
-    if not os.path.exists(config_path):
-        logger.error(f"{core_type} config not found at {config_path}")
-        raise FileNotFoundError(f"{core_type} config not found at {config_path}")
+    global _free_ports, _port_lock
+    if count > settings.TEST_PORT_POOL_SIZE:
+        raise ValueError(f"Cannot allocate {count} ports from a pool of {settings.TEST_PORT_POOL_SIZE}")
+    if _free_ports is None:
+        _free_ports = asyncio.Queue()
+        for port in range(settings.TEST_PORT_BASE, settings.TEST_PORT_BASE + settings.TEST_PORT_POOL_SIZE):
+            _free_ports.put_nowait(port)
+        _port_lock = asyncio.Lock()
+    # One taker at a time, so two batches can't each end up holding half of what they need
+    async with _port_lock:
+        ports = []
+        try:
+            while len(ports) < count:
+                ports.append(await _free_ports.get())
+        except BaseException:
+            release_ports(ports)
+            raise
+        return ports
+
+def release_ports(ports: Sequence[int]):
+    for port in ports:
+        _free_ports.put_nowait(port)
 
-    # Ensure the core is executable
+def core_available(core_path: str) -> bool:
+    """True if a non-empty core binary exists at core_path."""
     try:
-        os.chmod(core_path, 0o755)
-    except Exception as e:
-        logger.warning(f"Could not chmod {core_path}: {e}")
+        return os.path.getsize(core_path) > 0
+    except OSError: # Missing
+        return False
 
+async def _wait_port_ready(port: int, process: asyncio.subprocess.Process, deadline: float) -> bool:
+    """
+    Polls 127.0.0.1:port until it accepts a connection.
+    Returns False once the loop clock passes deadline or if the process exits while we wait.
+    """
+    loop = asyncio.get_running_loop()
+    while process.returncode is None:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout=remaining)
+        except (OSError, asyncio.TimeoutError):
+            await asyncio.sleep(0.02)
+            continue
+        writer.close()
+        return True
+    return False
 
-    command = []
+def _core_command(core_type: str, core_path: str, config_path: str) -> Tuple[str, ...]:
+    """Builds the launch command. Every batch has its own config file, so there's nothing to memoize."""
     if core_type == "clash":
         # Clash Meta: ./clash-meta -d /path/to/config_dir (where config.yaml is)
         # The config file must be named config.yaml or specified with -f
         # For simplicity, we assume config_path is the full path to the config file.
         # We'll tell Clash where its "home" directory is, which contains the config.
-        config_dir = os.path.dirname(config_path)
-        command = [core_path, "-d", config_dir, "-f", config_path]
-    elif core_type == "singbox":
+        return (core_path, "-d", os.path.dirname(config_path), "-f", config_path)
+    if core_type == "singbox":
         # Sing-box: ./sing-box run -c /path/to/config.json
-        command = [core_path, "run", "-c", config_path] # V1.8+ `run` command
+        return (core_path, "run", "-c", config_path) # V1.8+ `run` command
         # Older versions might use `sing-box -c /path/to/config.json` directly
+    raise ValueError(f"Unknown core type: {core_type}")
+
+async def run_proxy_core(core_path: str, config_path: str, core_type: str, ready_ports: Sequence[int] = (), ready_timeout: float = 10.0):
+    """
+    Starts the proxy core (Clash or Singbox) as a subprocess.
+    If ready_ports are given (e.g. proxy and controller ports), waits until the
+    core listens on all of them, at most ready_timeout in total, instead of sleeping blindly.
+    Returns the process object.
+    """
+    if not os.path.exists(core_path):
+        logger.error("%s core not found at %s", core_type, core_path)
+        raise FileNotFoundError(f"{core_type} core not found at {core_path}")
+    if not os.path.exists(config_path):
+        logger.error("%s config not found at %s", core_type, config_path)
+        raise FileNotFoundError(f"{core_type} config not found at {config_path}")
+
+    # Ensure the core is executable (once per path; cores are restarted per test)
+    if core_path not in _executable_checked:
+        try:
+            st = os.stat(core_path)
+            if not st.st_mode & 0o111:
+                os.chmod(core_path, st.st_mode | 0o755)
+            _executable_checked.add(core_path)
+        except Exception as e:
+            logger.warning("Could not chmod %s: %s", core_path, e)
+
 
-    logger.info(f"Starting {core_type} with command: {' '.join(command)}")
+    command = _core_command(core_type, core_path, config_path)
+    logger.info("Starting %s with command: %s", core_type, command)
     
-    # Use asyncio.create_subprocess_exec for non-blocking operation
-    # Capture stdout/stderr for debugging if needed
+    # Use asyncio.create_subprocess_exec for non-blocking operation.
+    # Output is only piped when it will be read: an unread PIPE fills up and
+    # blocks the core, which then ignores SIGTERM until it gets killed.
+    output = asyncio.subprocess.PIPE if settings.DEBUG_CORE else asyncio.subprocess.DEVNULL
     process = await asyncio.create_subprocess_exec(
         *command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+        stdout=output,
+        stderr=output
     )
-    # Give it a moment to start up
-    await asyncio.sleep(2) # Adjust as needed; ideally check for port listening
-    logger.info(f"{core_type} process started (PID: {process.pid}).")
+    if settings.DEBUG_CORE:
+        monitor_process_output(process, core_type)
+    if ready_ports:
+        # All ports share one deadline and are polled together, so a slow port
+        # doesn't stretch the total wait to ready_timeout per port.
+        deadline = asyncio.get_running_loop().time() + ready_timeout
+        ready = await asyncio.gather(*(_wait_port_ready(port, process, deadline) for port in ready_ports))
+        for port, is_ready in zip(ready_ports, ready):
+            if not is_ready:
+                logger.warning("%s (PID: %s) is not listening on port %s.", core_type, process.pid, port)
+    else:
+        # Give it a moment to start up
+        await asyncio.sleep(2)
+    logger.info("%s process started (PID: %s).", core_type, process.pid)
     return process
 
+async def _terminate(process: asyncio.subprocess.Process, core_type: str):
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), timeout=5.0)
+        logger.info("%s process terminated.", core_type)
+    except asyncio.TimeoutError:
+        logger.warning("%s process did not terminate gracefully, killing.", core_type)
+        process.kill()
+        await process.wait()
+        logger.info("%s process killed.", core_type)
+    except ProcessLookupError: # Exited between the returncode check and terminate()
+        await process.wait()
+    except Exception as e:
+        logger.error("Error stopping %s process: %s", core_type, e)
+
+async def _join_monitor_tasks(pid: int):
+    tasks = _monitor_tasks.pop(pid, [])
+    if not tasks:
+        return
+    # The process is gone, so its pipes are at EOF: give the readers a moment to
+    # log the tail of the output, then cancel whatever is still pending.
+    _, pending = await asyncio.wait(tasks, timeout=1.0)
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
 async def stop_proxy_core(process: asyncio.subprocess.Process, core_type: str):
-    """Stops the proxy core process."""
-    if process and process.returncode is None: # Check if process is running
-        logger.info(f"Stopping {core_type} process (PID: {process.pid})...")
-        try:
-            process.terminate()
-            await asyncio.wait_for(process.wait(), timeout=5.0)
-            logger.info(f"{core_type} process terminated.")
-        except asyncio.TimeoutError:
-            logger.warning(f"{core_type} process did not terminate gracefully, killing.")
+    """Stops the proxy core process and joins its output reader tasks."""
+    if not process:
+        logger.info("No active %s process to stop.", core_type)
+        return
+    try:
+        if process.returncode is None: # Check if process is running
+            logger.info("Stopping %s process (PID: %s)...", core_type, process.pid)
+            await _terminate(process, core_type)
+        else:
+            logger.info("%s process (PID: %s) already stopped with code %s.", core_type, process.pid, process.returncode)
+    finally:
+        # Also runs if the caller is cancelled mid-shutdown, so neither the core
+        # nor its reader tasks outlive this call.
+        if process.returncode is None:
             process.kill()
-            await process.wait()
-            logger.info(f"{core_type} process killed.")
-        except Exception as e:
-            logger.error(f"Error stopping {core_type} process: {e}")
-    elif process:
-        logger.info(f"{core_type} process (PID: {process.pid}) already stopped with code {process.returncode}.")
-    else:
-        logger.info(f"No active {core_type} process to stop.")
+        await _join_monitor_tasks(process.pid)
 
-async def monitor_process_output(process: asyncio.subprocess.Process, core_type: str):
-    """Monitors stdout and stderr of the process for debugging."""
+def monitor_process_output(process: asyncio.subprocess.Process, core_type: str) -> List[asyncio.Task]:
+    """
+    Starts background tasks that log stdout and stderr of the process for debugging.
+    Returns immediately; the tasks are cancelled by stop_proxy_core.
+    """
     async def read_stream(stream, stream_name):
         while True:
             line = await stream.readline()
             if line:
-                logger.debug(f"[{core_type} {stream_name} PID:{process.pid}]: {line.decode().strip()}")
+                # Runs once per output line of the core: skip the decode when DEBUG is filtered out
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[%s %s PID:%s]: %s", core_type, stream_name, process.pid, line.decode().strip())
             else:
                 break
     
+    tasks = []
     if process.stdout:
-      await asyncio.create_task(read_stream(process.stdout, "stdout"))
+        tasks.append(asyncio.create_task(read_stream(process.stdout, "stdout")))
     if process.stderr:
-      await asyncio.create_task(read_stream(process.stderr, "stderr"))
\ No newline at end of file
+        tasks.append(asyncio.create_task(read_stream(process.stderr, "stderr")))
+    _monitor_tasks.setdefault(process.pid, []).extend(tasks)
+    return tasks
+
+def _get_controller_client() -> httpx.AsyncClient:
+    global _controller_client
+    if _controller_client is None or _controller_client.is_closed:
+        # trust_env=False: an HTTP(S)_PROXY in the environment must not capture localhost calls
+        _controller_client = httpx.AsyncClient(trust_env=False, timeout=5.0)
+    return _controller_client
+
+async def close_controller_client():
+    """Closes the controller client. Called on application shutdown."""
+    global _controller_client
+    if _controller_client is not None:
+        await _controller_client.aclose()
+        _controller_client = None
+
+async def set_active_proxy(controller_port: int, name: str, group: str = "GLOBAL"):
+    """
+    Switches a running core's selector group to the named proxy through its
+    Clash-compatible controller API (Mihomo external-controller, or sing-box
+    experimental.clash_api). Lets one long-lived core test many nodes without
+    a restart per node. Raises httpx.HTTPError if the switch is rejected.
+    """
+    url = f"http://127.0.0.1:{controller_port}/proxies/{urllib.parse.quote(group, safe='')}"
+    response = await _get_controller_client().put(url, json={"name": name})
+    response.raise_for_status()
+
+async def close_connections(controller_port: int, group: Optional[str] = None):
+    """
+    Closes connections currently open through a running core (only those routed
+    through `group`, if given), so kept-alive tunnels don't keep using the node
+    that was selected before a switch.
+    """
+    client = _get_controller_client()
+    base_url = f"http://127.0.0.1:{controller_port}/connections"
+    if group is None:
+        response = await client.delete(base_url)
+        response.raise_for_status()
+        return
+    response = await client.get(base_url)
+    response.raise_for_status()
+    ids = [c["id"] for c in response.json().get("connections") or [] if group in (c.get("chains") or [])]
+    if ids:
+        await asyncio.gather(*(client.delete(f"{base_url}/{conn_id}") for conn_id in ids))
@@ -1,25 +1,43 @@
 import base64
+import copy
+import hashlib
 import os
 import asyncio
 import yaml
 import json
+import orjson
 import httpx
 import logging
+import re
+import tempfile
 import urllib.parse
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 from backend.app.core.config import settings
-from backend.app.core.ip_checker import get_exit_ip_country
-from backend.app.core.proxy_manager import run_proxy_core, stop_proxy_core, monitor_process_output
+from backend.app.core.ip_checker import get_exit_ip, new_proxy_client, get_cached_country, store_country, lookup_countries
+from backend.app.core.proxy_manager import core_available, run_proxy_core, stop_proxy_core, set_active_proxy, close_connections, acquire_ports, release_ports
+
+try: # libyaml C bindings, much faster on large Clash configs
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError: # PyYAML built without libyaml
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 logger = logging.getLogger(__name__)
 
+# A body starting with "{" (after whitespace) is sing-box JSON; match() stops at the first non-space character
+_JSON_OBJECT_RE = re.compile(r"\s*\{")
+# A top-level `proxies:` key marks a Clash YAML config (or proxy-provider file)
+_CLASH_PROXIES_RE = re.compile(r"^proxies:", re.MULTILINE)
+# A body made only of Base64 alphabet (plus line breaks) is an encoded link list;
+# plain share links always contain "://", which can't match.
+_BASE64_RE = re.compile(r"[A-Za-z0-9+/=\s]+")
+
 # --- Node Parsing (Simplified Examples) ---
 def parse_vmess_link(vmess_link: str) -> Optional[Dict[str, Any]]:
     if not vmess_link.startswith("vmess://"):
         return None
     try:
-        decoded_json_str = base64.b64decode(vmess_link[8:]).decode('utf-8')
-        data = json.loads(decoded_json_str)
+        data = orjson.loads(base64.b64decode(vmess_link[8:])) # orjson takes the UTF-8 bytes directly
         # Basic structure, more fields might be needed (tls, sni, etc.)
         return {
             "name": data.get("ps", "Unnamed VMess"),
@@ -46,15 +64,16 @@ def parse_trojan_link(trojan_link: str) -> Optional[Dict[str, Any]]:
     if not trojan_link.startswith("trojan://"):
         return None
     try:
-        parts = urllib.parse.urlparse(trojan_link)
+        parts = urllib.parse.urlsplit(trojan_link) # No ;params in trojan links, so urlsplit is enough
         password = parts.username
         server = parts.hostname
         port = parts.port
-        remarks = urllib.parse.unquote(parts.fragment) if parts.fragment else f"{server}:{port}"
+        fragment = parts.fragment
+        remarks = urllib.parse.unquote(fragment) if fragment else f"{server}:{port}"
         
-        query_params = urllib.parse.parse_qs(parts.query)
-        sni = query_params.get('sni', [None])[0]
-        allow_insecure = query_params.get('allowInsecure', ['0'])[0] == '1' # Clash uses skip-cert-verify
+        get_param = urllib.parse.parse_qs(parts.query).get
+        sni = get_param('sni', [None])[0]
+        allow_insecure = get_param('allowInsecure', ['0'])[0] == '1' # Clash uses skip-cert-verify
         # Other params like peer, alpn, etc. could be here
 
         return {
@@ -75,18 +94,101 @@ def parse_trojan_link(trojan_link: str) -> Optional[Dict[str, Any]]:
 # Add parsers for Shadowsocks (ss://), VLESS, Hysteria2 as needed.
 # Hysteria2 is complex, often provided as JSON snippet.
 
-async def fetch_and_parse_subscription(url: str) -> List[Dict[str, Any]]:
+# Link scheme -> parser. Register new parsers here.
+PARSERS = {
+    "vmess": parse_vmess_link,
+    "trojan": parse_trojan_link,
+}
+
+def _copy_node(node: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Independent copy of a node, nested options (ws-opts, plugin-opts...) included:
+    a nested dict shared between nodes is written by yaml.dump as an &id/*id alias.
+    """
+    return copy.deepcopy(node)
+
+def _parse_link_list(text: str) -> List[Dict[str, Any]]:
+    """Parses one share link per line, skipping unsupported schemes and bad links."""
+    nodes = []
+    for link in text.splitlines():
+        link = link.strip()
+        scheme, sep, _ = link.partition("://")
+        parser = PARSERS.get(scheme) if sep else None
+        if parser:
+            node = parser(link)
+            if node: nodes.append(node)
+    return nodes
+
+# Parsed nodes keyed by sha256 of the subscription body, so unchanged content is never
+# re-parsed, plus the last ETag seen per URL to revalidate without downloading the body.
+_PARSE_CACHE_SIZE = 64
+_parse_cache = OrderedDict() # content hash -> parsed nodes, in LRU order
+# Subscription URLs usually carry access tokens, so keep only as many as there are cached bodies
+_etags: "OrderedDict[str, Tuple[str, str]]" = OrderedDict() # url -> (etag, content hash), in LRU order
+
+def _get_parsed(content_hash: str) -> Optional[List[Dict[str, Any]]]:
+    nodes = _parse_cache.get(content_hash)
+    if nodes is None:
+        return None
+    _parse_cache.move_to_end(content_hash)
+    # Callers rename nodes in place, so hand out copies
+    return [_copy_node(n) for n in nodes]
+
+def _store_etag(url: str, etag: str, content_hash: str):
+    _etags[url] = (etag, content_hash)
+    _etags.move_to_end(url)
+    while len(_etags) > _PARSE_CACHE_SIZE:
+        _etags.popitem(last=False)
+
+def _store_parsed(content_hash: str, nodes: List[Dict[str, Any]]):
+    _parse_cache[content_hash] = [_copy_node(n) for n in nodes]
+    _parse_cache.move_to_end(content_hash)
+    while len(_parse_cache) > _PARSE_CACHE_SIZE:
+        _parse_cache.popitem(last=False)
+
+async def fetch_and_parse_subscription(url: str, client: httpx.AsyncClient) -> List[Dict[str, Any]]:
+    """Fetches one subscription with the shared client and parses it into nodes."""
     nodes = []
     try:
-        async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
+        etag, etag_hash = _etags.get(url, (None, None))
+        if etag and etag_hash in _parse_cache:
+            response = await client.get(url, headers={"If-None-Match": etag})
+            if response.status_code == 304:
+                cached_nodes = _get_parsed(etag_hash)
+                if cached_nodes is not None:
+                    _etags.move_to_end(url)
+                    logger.info(f"{url} not modified, reusing {len(cached_nodes)} parsed nodes")
+                    return cached_nodes
+                response = await client.get(url) # Evicted meanwhile, fetch the body after all
+        else:
             response = await client.get(url)
-            response.raise_for_status()
-            content = response.text
+        response.raise_for_status()
+        content = response.text
+
+        content_hash = hashlib.sha256(content.encode()).hexdigest()
+        if response.headers.get("ETag"):
+            _store_etag(url, response.headers["ETag"], content_hash)
+        cached_nodes = _get_parsed(content_hash)
+        if cached_nodes is not None:
+            logger.info(f"Content of {url} unchanged, reusing {len(cached_nodes)} parsed nodes")
+            return cached_nodes
+
+        # Determine content type (SingBox JSON, Clash YAML, Base64 blob) from its first
+        # byte / a top-level key rather than substring scans over the whole payload.
+        # JSON is checked first since json.loads is far cheaper than YAML parsing.
+        if _JSON_OBJECT_RE.match(content): # SingBox JSON
+            logger.info(f"Parsing {url} as SingBox JSON")
+            sb_config = orjson.loads(content)
+            # SingBox outbounds are more complex. Need to map them.
+            # For simplicity, assuming we can extract relevant fields.
+            for outbound in sb_config.get("outbounds", []):
+                if outbound.get("type") in ["vmess", "trojan", "shadowsocks", "vless", "hysteria2"]:
+                     nodes.append({**outbound, "_source_format": "singbox_dict"}) # Simplification
+            logger.info(f"Parsed {len(nodes)} nodes from SingBox JSON.")
 
-        # Try to determine content type (Base64 blob, Clash YAML, SingBox JSON)
-        if "proxies:" in content and ("Proxy" in content or "proxy-groups" in content): # Basic Clash YAML check
+        elif _CLASH_PROXIES_RE.search(content): # Clash YAML
             logger.info(f"Parsing {url} as Clash YAML")
-            clash_config = yaml.safe_load(content)
+            clash_config = yaml.load(content, Loader=YamlLoader)
             proxies_data = clash_config.get('proxies', [])
             for proxy_data in proxies_data:
                 # Convert Clash proxy dict to our internal common format
@@ -94,44 +196,18 @@ async def fetch_and_parse_subscription(url: str) -> List[Dict[str, Any]]:
                 nodes.append({**proxy_data, "_source_format": "clash_dict"})
             logger.info(f"Parsed {len(nodes)} nodes from Clash YAML.")
 
-        elif content.startswith("{") and "\"outbounds\"" in content : # Basic SingBox JSON check
-            logger.info(f"Parsing {url} as SingBox JSON")
-            sb_config = json.loads(content)
-            # SingBox outbounds are more complex. Need to map them.
-            # For simplicity, assuming we can extract relevant fields.
-            for outbound in sb_config.get("outbounds", []):
-                if outbound.get("type") in ["vmess", "trojan", "shadowsocks", "vless", "hysteria2"]:
-                     nodes.append({**outbound, "_source_format": "singbox_dict"}) # Simplification
-            logger.info(f"Parsed {len(nodes)} nodes from SingBox JSON.")
-
-        else: # Assume Base64 encoded list of links (common for V2RayN, Shadowrocket)
-            logger.info(f"Parsing {url} as Base64 encoded links")
-            try:
-                decoded_content = base64.b64decode(content).decode('utf-8')
-                links = decoded_content.splitlines()
-                for link in links:
-                    link = link.strip()
-                    if link.startswith("vmess://"):
-                        node = parse_vmess_link(link)
-                        if node: nodes.append(node)
-                    elif link.startswith("trojan://"):
-                        node = parse_trojan_link(link)
-                        if node: nodes.append(node)
-                    # Add elif for ss://, vless:// etc.
-                logger.info(f"Parsed {len(nodes)} nodes from Base64 link list.")
-            except Exception as e:
-                logger.error(f"Failed to decode or parse Base64 content from {url}: {e}")
-                # Could try parsing line by line if not base64
-                raw_links = content.splitlines()
-                for link in raw_links:
-                    link = link.strip()
-                    if link.startswith("vmess://"):
-                        node = parse_vmess_link(link)
-                        if node: nodes.append(node)
-                    elif link.startswith("trojan://"):
-                        node = parse_trojan_link(link)
-                        if node: nodes.append(node)
+        else: # Assume a list of links (common for V2RayN, Shadowrocket), usually Base64 encoded
+            if _BASE64_RE.fullmatch(content):
+                logger.info(f"Parsing {url} as Base64 encoded links")
+                link_text = base64.b64decode(content).decode('utf-8')
+            else: # Some providers serve the links as plain text
+                logger.info(f"Parsing {url} as plain links")
+                link_text = content
+            nodes = _parse_link_list(link_text)
+            logger.info(f"Parsed {len(nodes)} nodes from link list.")
 
+        if nodes:
+            _store_parsed(content_hash, nodes)
 
     except httpx.RequestError as e:
         logger.error(f"Failed to fetch subscription from {url}: {e}")
@@ -144,149 +220,229 @@ async def fetch_and_parse_subscription(url: str) -> List[Dict[str, Any]]:
     return nodes
 
 
-async def test_and_rename_node(node: Dict[str, Any], use_clash: bool = True) -> Dict[str, Any]:
-    """
-    Tests a single node by creating a temporary config for Clash/Singbox,
-    running it, querying IP API, and then stopping it.
-    Modifies node['name'] with country prefix.
-    """
-    original_name = node.get("name", "Unnamed Node")
-    logger.info(f"Testing node: {original_name} (type: {node.get('type')})")
+def _strip_internal(node: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of a node without its `_`-prefixed helper fields, i.e. as the cores and clients see it."""
+    return {k: v for k, v in node.items() if not k.startswith('_')}
+
+
+def _node_cache_key(node: Dict[str, Any]) -> str:
+    """Stable identity of a node's upstream, ignoring its display name and helper fields."""
+    identity = {k: v for k, v in node.items() if k != "name" and not k.startswith('_')}
+    return hashlib.sha1(json.dumps(identity, sort_keys=True, default=str).encode()).hexdigest()
 
-    # 1. Generate temporary minimal proxy config
-    temp_config_content = None
-    core_type_to_run = "clash" if use_clash else "singbox" # Default to Clash for now
-    temp_config_path = settings.TEMP_CLASH_CONFIG_PATH if use_clash else settings.TEMP_SINGBOX_CONFIG_PATH
-    proxy_core_path = settings.CLASH_CORE_PATH if use_clash else settings.SINGBOX_CORE_PATH
-    
-    # Ensure the selected core binary exists
-    if not os.path.exists(proxy_core_path) or os.path.getsize(proxy_core_path) == 0:
-        logger.error(f"{core_type_to_run} core binary missing or empty at {proxy_core_path}. Skipping test for {original_name}")
-        node["name"] = f"[ER-CORE] {original_name}"
-        return node
 
+def _write_test_config(nodes: List[Dict[str, Any]], use_clash: bool, config_path: str,
+                       lane_ports: List[int], controller_port: int):
+    """
+    Writes one core config holding every node. Each lane gets its own local
+    inbound port routed to its own selector group (LANE-k) over all nodes, so
+    several nodes can be tested at once. Nodes are added under their unique
+    `_test_tag`, since display names may repeat.
+    """
+    tags = [node["_test_tag"] for node in nodes]
+    groups = [f"LANE-{k}" for k in range(len(lane_ports))]
     if use_clash:
-        # Create a minimal Clash config with only this proxy
         # Important: Clash needs 'proxies' and 'proxy-groups'
-        # For global mode, we'll point a group to this single proxy and select it.
-        clash_proxy_config = {**node} # Make a copy
-        # Remove helper fields not part of clash spec, or convert them
-        clash_proxy_config.pop("_original_link", None)
-        clash_proxy_config.pop("_source_format", None)
-        # Ensure all necessary fields for the specific type are present and correctly named for Clash
-        # e.g. vmess `security` field in Clash is `cipher` in some URI schemes.
+        # Each listener sends its traffic straight to its lane's group, bypassing rules.
+        clash_proxies = []
+        for node in nodes:
+            # Remove helper fields not part of clash spec
+            clash_proxy_config = _strip_internal(node)
+            clash_proxy_config["name"] = node["_test_tag"]
+            clash_proxies.append(clash_proxy_config)
 
         temp_config_content = {
-            "port": settings.TEMP_PROXY_PORT, # HTTP proxy port
-            "socks-port": settings.TEMP_PROXY_PORT + 1, # SOCKS proxy port
-            "allow-lan": True,
-            "mode": "global", # Use global mode for testing
+            "allow-lan": False, # The core now lives for a whole batch; keep it local-only
+            "mode": "rule",
             "log-level": "silent", # "info" or "debug" for verbose logs
-            "external-controller": f"127.0.0.1:{settings.TEMP_PROXY_PORT+2}", # Not strictly needed for this use case
-            "proxies": [clash_proxy_config],
+            "external-controller": f"127.0.0.1:{controller_port}", # Lets set_active_proxy switch nodes without a restart
+            "listeners": [
+                {
+                    "name": group.lower(),
+                    "type": "mixed", # HTTP and SOCKS on one port
+                    "listen": "127.0.0.1",
+                    "port": port,
+                    "proxy": group
+                }
+                for group, port in zip(groups, lane_ports)
+            ],
+            "proxies": clash_proxies,
             "proxy-groups": [
                 {
-                    "name": "GLOBAL",
+                    "name": group,
                     "type": "select",
-                    "proxies": [node["name"]] # Use the node's name
+                    "proxies": tags
                 }
+                for group in groups
             ],
-            "rules": ["MATCH,GLOBAL"] # Ensure global routing
+            "rules": ["MATCH,REJECT"] # Nothing may leave unproxied, which would report our own country
         }
-        with open(temp_config_path, 'w', encoding='utf-8') as f:
-            yaml.dump(temp_config_content, f, allow_unicode=True)
+        with open(config_path, 'w', encoding='utf-8') as f:
+            yaml.dump(temp_config_content, f, allow_unicode=True, Dumper=YamlDumper)
     else: # Singbox
-        # Create a minimal Singbox config
         # Singbox needs "log", "inbounds", "outbounds"
-        # The node itself is an outbound.
+        # Every node is an outbound; one selector per lane picks the lane's active node.
         # Inbound type "mixed" can listen for HTTP and SOCKS5
-        singbox_outbound_config = {**node} # Make a copy
-        singbox_outbound_config.pop("_original_link", None)
-        singbox_outbound_config.pop("_source_format", None)
-        singbox_outbound_config["tag"] = "proxy" # Required field for outbounds
+        singbox_outbounds = []
+        for node in nodes:
+            singbox_outbound_config = _strip_internal(node)
+            singbox_outbound_config["tag"] = node["_test_tag"] # Required field for outbounds
+            singbox_outbounds.append(singbox_outbound_config)
 
         temp_config_content = {
             "log": {"level": "warn", "output": "stderr"},
             "inbounds": [
                 {
                     "type": "mixed",
-                    "tag": "mixed-in",
+                    "tag": group.lower(),
                     "listen": "127.0.0.1",
-                    "listen_port": settings.TEMP_PROXY_PORT
+                    "listen_port": port
                 }
+                for group, port in zip(groups, lane_ports)
             ],
-            "outbounds": [
-                singbox_outbound_config,
+            "outbounds": singbox_outbounds + [
+                {
+                    "type": "selector",
+                    "tag": group,
+                    "outbounds": tags,
+                    "interrupt_exist_connections": True # Don't keep tunnels on the previous node
+                }
+                for group in groups
+            ] + [
                 { # Default direct outbound for DNS or other needs if any
                     "type": "direct",
                     "tag": "direct"
                 }
             ],
-             "route": { # Route all traffic to the "proxy" outbound
-                "rules": [{"outbound": "proxy"}],
-                "final": "proxy" # Fallback to proxy
+            "route": {
+                # Route each lane's inbound to its own selector
+                "rules": [{"inbound": [group.lower()], "outbound": group} for group in groups]
+            },
+            "experimental": { # Clash-compatible controller, used by set_active_proxy
+                "clash_api": {"external_controller": f"127.0.0.1:{controller_port}"}
             }
         }
-        with open(temp_config_path, 'w', encoding='utf-8') as f:
+        with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(temp_config_content, f, indent=2)
 
-    # 2. Run proxy core
-    process = None
-    country_code = "XX" # Default unknown
+
+async def probe_exit_ip(node: Dict[str, Any], process: asyncio.subprocess.Process, core_type: str,
+                        group: str, proxy_port: int, controller_port: int, client: httpx.AsyncClient):
+    """
+    Tests a single node on an already running core (see _test_nodes_on_core) by
+    switching one lane's selector `group` to it and fetching the exit IP through
+    that lane's inbound port with the lane's client. Stores node['_exit_ip'] on success, otherwise a
+    failure code in node['_country']; process_subscriptions resolves and renames.
+    """
+    original_name = node.get("name", "Unnamed Node")
+    logger.info(f"Testing node: {original_name} (type: {node.get('type')})")
+
+    if process.returncode is not None:
+        logger.error(f"{core_type} exited with code {process.returncode} before {original_name} could be tested.")
+        node["_country"] = "FL" # Core failed
+        return
     try:
-        process = await run_proxy_core(proxy_core_path, temp_config_path, core_type_to_run)
-        # Start monitoring output in the background (optional, for debugging)
-        # output_monitor_task = asyncio.create_task(monitor_process_output(process, core_type_to_run))
-        
-        # Allow some time for the proxy to fully initialize and listen
-        await asyncio.sleep(3) # Adjust if proxy takes longer
+        await set_active_proxy(controller_port, node["_test_tag"], group=group)
+        # Drop this lane's connections still tunnelled through the previously selected node
+        await close_connections(controller_port, group=group)
+        # HTTP proxy is what we need for httpx typically
+        exit_ip, failure = await get_exit_ip(f"http://127.0.0.1:{proxy_port}", client=client)
+    except Exception as e:
+        logger.error(f"Error during testing node {original_name} with {core_type}: {e}", exc_info=True)
+        node["_country"] = "TE" # Test Error
+        return
+    if exit_ip:
+        logger.info(f"Node {original_name} tested. Exit IP: {exit_ip}")
+        node["_exit_ip"] = exit_ip
+    else:
+        node["_country"] = failure
 
-        # Check if process is still running
+
+async def _test_nodes_on_core(nodes: List[Dict[str, Any]], use_clash: bool):
+    """
+    Starts one core loaded with all of `nodes` and tests up to
+    settings.TEST_CONCURRENCY of them at a time, one per lane, by switching the
+    lanes' selectors instead of starting a core per node.
+    If the core rejects the combined config (e.g. one malformed node), the batch
+    is split in half and retried, so a bad node only fails itself.
+    """
+    core_type = "clash" if use_clash else "singbox"
+    core_path = settings.CLASH_CORE_PATH if use_clash else settings.SINGBOX_CORE_PATH
+    # TEST_CONCURRENCY comes from the environment; one port of the pool is the controller's
+    lane_count = max(1, min(settings.TEST_CONCURRENCY, settings.TEST_PORT_POOL_SIZE - 1, len(nodes)))
+
+    process = None
+    config_path = None
+    lane_clients = []
+    failed_to_start = False
+    # Ports and config file are private to this core, so concurrent batches don't collide
+    ports = await acquire_ports(lane_count + 1)
+    try:
+        controller_port, lane_ports = ports[0], ports[1:]
+        fd, config_path = tempfile.mkstemp(prefix=f"{core_type}-", suffix=".yaml" if use_clash else ".json", dir=settings.TEMP_DIR)
+        os.close(fd)
+        # Serializing and writing a config for thousands of nodes would block every other request
+        await asyncio.to_thread(_write_test_config, nodes, use_clash, config_path, lane_ports, controller_port)
+        # Core output is logged by monitor_process_output when settings.DEBUG_CORE is enabled
+        process = await run_proxy_core(core_path, config_path, core_type, ready_ports=ports)
         if process.returncode is not None:
-            logger.error(f"{core_type_to_run} for node {original_name} exited prematurely with code {process.returncode}.")
-            # Read stderr if available
-            if process.stderr:
-                error_output = await process.stderr.read()
-                logger.error(f"Stderr from {core_type_to_run}: {error_output.decode(errors='ignore')}")
-            country_code = "FL" # Failed to start
+            logger.error(f"{core_type} exited prematurely with code {process.returncode} for a batch of {len(nodes)} nodes.")
+            failed_to_start = True
         else:
-            # 3. Query IP API through the proxy
-            # HTTP proxy is what we need for httpx typically
-            local_proxy_url = f"http://127.0.0.1:{settings.TEMP_PROXY_PORT}"
-            country_code = await get_exit_ip_country(local_proxy_url)
-            logger.info(f"Node {original_name} tested. Country: {country_code}")
-
+            # One worker per lane pulls nodes off a shared queue, so only lane_count
+            # tests exist at a time however large the subscription is
+            pending = asyncio.Queue()
+            for node in nodes:
+                pending.put_nowait(node)
+
+            async def _lane_worker(group: str, port: int):
+                # Kept for the whole batch so the lane's nodes share keep-alive connections
+                lane_client = new_proxy_client(f"http://127.0.0.1:{port}")
+                lane_clients.append(lane_client)
+                while not pending.empty():
+                    node = pending.get_nowait()
+                    await probe_exit_ip(node, process, core_type, group, port, controller_port, lane_client)
+
+            await asyncio.gather(*(_lane_worker(f"LANE-{k}", port) for k, port in enumerate(lane_ports)))
     except FileNotFoundError:
-        logger.error(f"{core_type_to_run} core not found. Cannot test {original_name}.")
-        country_code = "NC" # No Core
+        logger.error(f"{core_type} core not found. Cannot test {len(nodes)} nodes.")
+        for node in nodes:
+            node["_country"] = "NC" # No Core
     except Exception as e:
-        logger.error(f"Error during testing node {original_name} with {core_type_to_run}: {e}", exc_info=True)
-        country_code = "TE" # Test Error
+        logger.error(f"Error starting {core_type} for {len(nodes)} nodes: {e}", exc_info=True)
+        for node in nodes:
+            node["_country"] = "TE" # Test Error
     finally:
-        # 4. Stop proxy core
+        for lane_client in lane_clients:
+            await lane_client.aclose()
         if process:
-            await stop_proxy_core(process, core_type_to_run)
-        # if 'output_monitor_task' in locals() and not output_monitor_task.done():
-        #     output_monitor_task.cancel()
-        
+            await stop_proxy_core(process, core_type)
+        release_ports(ports)
         # Clean up temp config file
         try:
-            if os.path.exists(temp_config_path):
-                os.remove(temp_config_path)
+            if config_path and os.path.exists(config_path):
+                os.remove(config_path)
         except Exception as e:
-            logger.warning(f"Could not remove temp config {temp_config_path}: {e}")
+            logger.warning(f"Could not remove temp config {config_path}: {e}")
 
+    if failed_to_start:
+        if len(nodes) == 1:
+            nodes[0]["_country"] = "FL" # Failed to start
+            return
+        mid = len(nodes) // 2
+        await _test_nodes_on_core(nodes[:mid], use_clash)
+        await _test_nodes_on_core(nodes[mid:], use_clash)
 
-    node["name"] = f"[{country_code}] {original_name}"
-    return node
 
-
-async def process_subscriptions(urls: List[str], output_format: str = "clash") -> str:
+async def process_subscriptions(urls: List[str], client: httpx.AsyncClient, output_format: str = "clash") -> str:
+    logger.info(f"Fetching and parsing {len(urls)} subscription(s) concurrently")
+    results = await asyncio.gather(*(fetch_and_parse_subscription(u, client) for u in urls), return_exceptions=True)
     all_nodes = []
-    for url in urls:
-        logger.info(f"Fetching and parsing subscription: {url}")
-        nodes = await fetch_and_parse_subscription(url)
-        all_nodes.extend(nodes)
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to fetch and parse subscription {url}: {result}")
+            continue
+        all_nodes.extend(result)
 
     logger.info(f"Total nodes collected: {len(all_nodes)}. Now testing...")
     
@@ -294,52 +450,71 @@ async def process_subscriptions(urls: List[str], output_format: str = "clash") -
     # or make it configurable. For now, defaulting to Clash for testing.
     # Hysteria2 is better supported in Singbox usually.
     # If a node is already in Singbox format, maybe test with Singbox.
-    
-    # Limit concurrent tests to avoid overwhelming the system or IP API rate limits
-    semaphore = asyncio.Semaphore(5) # Max 5 concurrent tests
-    tested_nodes_tasks = []
+    clash_nodes, singbox_nodes = [], []
+    # The cores don't change during a request, so check for them once
+    clash_ok = core_available(settings.CLASH_CORE_PATH)
+    singbox_ok = core_available(settings.SINGBOX_CORE_PATH)
+
+    for i, node in enumerate(all_nodes):
+        # A recent result for the same upstream makes testing the node unnecessary
+        cached_country = get_cached_country(_node_cache_key(node))
+        if cached_country:
+            logger.info(f"Node {node.get('name')} found in IP cache. Country: {cached_country}")
+            node["name"] = f"[{cached_country}] {node.get('name', 'Unnamed Node')}"
+            continue
 
-    for node in all_nodes:
         # Basic decision: if node type is hysteria2 or quic, prefer singbox
         # Or if source format was singbox.
         node_type = node.get("type", "").lower()
         is_hysteria = "hysteria" in node_type or "hy2" in node_type
-        is_quic_based = "quic" in node.get("network", "").lower()
+        is_quic_based = "quic" in (node.get("network") or "").lower()
         # For now, use Clash by default for wide compatibility of other types
         # This logic can be expanded.
         # For this example, let's try to use Clash more broadly if its core is available
-        # because its single-node config is often simpler to craft.
+        # because its config is often simpler to craft.
         use_clash_for_test = True
-        if (is_hysteria or is_quic_based) and os.path.exists(settings.SINGBOX_CORE_PATH) and os.path.getsize(settings.SINGBOX_CORE_PATH) > 0 :
+        if (is_hysteria or is_quic_based) and singbox_ok:
             use_clash_for_test = False
-        elif not (os.path.exists(settings.CLASH_CORE_PATH) and os.path.getsize(settings.CLASH_CORE_PATH) > 0):
+        elif not clash_ok:
             # If Clash core is missing, but Singbox is there, try Singbox
-            if os.path.exists(settings.SINGBOX_CORE_PATH) and os.path.getsize(settings.SINGBOX_CORE_PATH) > 0:
+            if singbox_ok:
                 use_clash_for_test = False
             else:
                 logger.warning(f"No suitable proxy core (Clash or Singbox) found for testing node {node.get('name')}. Skipping test.")
                 node["name"] = f"[SKP-CORE] {node.get('name', 'Unnamed')}"
-                # No async task for this node, just append it as is (or with error prefix)
-                # We'll add it to a list of already processed/skipped nodes.
-                # For simplicity, let's just create a task that returns the node as is.
-                async def return_node_as_is(n): return n
-                task = return_node_as_is(node)
-                tested_nodes_tasks.append(task)
                 continue
 
-
-        async def _acquire_and_test(n, use_clash_flag):
-            async with semaphore:
-                return await test_and_rename_node(n, use_clash=use_clash_flag)
-        
-        tested_nodes_tasks.append(_acquire_and_test(node, use_clash_for_test))
-
-    modified_nodes = await asyncio.gather(*tested_nodes_tasks)
+        node["_test_tag"] = f"node-{i}" # Unique name inside the test core's config
+        (clash_nodes if use_clash_for_test else singbox_nodes).append(node)
+
+    # One long-lived core per core type tests all of its nodes; each core has its
+    # own ports, so both run at the same time.
+    phases = []
+    if clash_nodes:
+        phases.append(_test_nodes_on_core(clash_nodes, use_clash=True))
+    if singbox_nodes:
+        phases.append(_test_nodes_on_core(singbox_nodes, use_clash=False))
+    await asyncio.gather(*phases)
+
+    # Exit IPs were collected while testing; resolve them all at once instead of one lookup per node
+    tested_nodes = clash_nodes + singbox_nodes
+    countries = await lookup_countries([node["_exit_ip"] for node in tested_nodes if "_exit_ip" in node])
+    for node in tested_nodes:
+        if "_exit_ip" in node:
+            country_code = countries.get(node["_exit_ip"], "XX") # Unknown
+            store_country(_node_cache_key(node), country_code)
+        else:
+            country_code = node["_country"]
+        node["name"] = f"[{country_code}] {node.get('name', 'Unnamed Node')}"
+    modified_nodes = all_nodes # Renamed in place, original order kept
     
     # Filter out nodes that completely failed or couldn't be processed if needed
     # modified_nodes = [n for n in modified_nodes if not n["name"].startswith("[ER-")]
 
     logger.info(f"Finished testing. Generating output in {output_format} format.")
+    # Client-facing form of every node and its final name, computed once for whichever format is rendered
+    public_nodes = [_strip_internal(node) for node in modified_nodes]
+    names = [node["name"] for node in public_nodes]
 
     # --- Output Generation ---
     # This also needs to be robust, converting internal node structure to target format
@@ -361,13 +536,9 @@ async def process_subscriptions(urls: List[str], output_format: str = "clash") -
                 "MATCH,手动选择"
             ]
         }
-        node_names_for_groups = []
-        for node_data in modified_nodes:
-            # Convert our internal representation back to Clash proxy dict
-            # This is inverse of parsing logic. Ensure all fields are correct.
-            clash_node = {k: v for k, v in node_data.items() if not k.startswith('_')}
-            clash_output["proxies"].append(clash_node)
-            node_names_for_groups.append(node_data["name"])
+        # Our internal representation is already a Clash proxy dict once helper fields are gone
+        clash_output["proxies"] = public_nodes
+        node_names_for_groups = names
         
         if not node_names_for_groups: # Handle case with no valid nodes
              clash_output["proxies"] = [{"name":"NO-NODES-VALID","type":"direct"}] # Placeholder
@@ -377,7 +548,8 @@ async def process_subscriptions(urls: List[str], output_format: str = "clash") -
         clash_output["proxy-groups"][0]["proxies"] = node_names_for_groups
         clash_output["proxy-groups"][1]["proxies"] = ["自动选择"] + node_names_for_groups # Manually select auto or individual
 
-        return yaml.dump(clash_output, allow_unicode=True, sort_keys=False)
+        # Dumping a large config takes a while; keep the event loop free for other requests
+        return await asyncio.to_thread(yaml.dump, clash_output, allow_unicode=True, sort_keys=False, Dumper=YamlDumper)
 
     elif output_format == "singbox":
         # Construct a valid Singbox JSON
@@ -393,12 +565,8 @@ async def process_subscriptions(urls: List[str], output_format: str = "clash") -
         }
         default_outbounds = [{"type": "direct", "tag": "DIRECT"}] # Must have a DIRECT
 
-        processed_outbounds = []
-        for node_data in modified_nodes:
-            # Convert internal to Singbox outbound dict
-            sb_node = {k: v for k, v in node_data.items() if not k.startswith('_')}
-            sb_node["tag"] = node_data["name"] # Use new name as tag
-            processed_outbounds.append(sb_node)
+        # Convert internal to Singbox outbound dict, using the new name as tag
+        processed_outbounds = [{**sb_node, "tag": name} for sb_node, name in zip(public_nodes, names)]
         
         if not processed_outbounds: # Handle no valid nodes
             sb_output["outbounds"] = default_outbounds
@@ -409,7 +577,9 @@ async def process_subscriptions(urls: List[str], output_format: str = "clash") -
             sb_output["route"]["final"] = processed_outbounds[0]["tag"]
 
 
-        return json.dumps(sb_output, indent=2, ensure_ascii=False)
+        # orjson always emits UTF-8 (like ensure_ascii=False); OPT_NON_STR_KEYS tolerates non-str keys from YAML sources
+        sb_json = await asyncio.to_thread(orjson.dumps, sb_output, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        return sb_json.decode()
 
     elif output_format == "v2rayn": # Base64 list of links
         output_links = []
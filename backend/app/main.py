@@ -1,12 +1,16 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+import httpx
 import logging
 import os
 
 from backend.app.models.subscription import SubscriptionRequest, SubscriptionResponse
+from backend.app.models.ip_check import IPCheckRequest, IPCheckResponse
 from backend.app.core.sub_converter import process_subscriptions
-from backend.app.utils.github_api import get_clash_meta_binary, get_singbox_binary
+from backend.app.core.proxy_manager import close_controller_client, core_available
+from backend.app.core.ip_checker import check_many, close_clients as close_ip_checker_clients, load_cache as load_ip_cache, save_cache as save_ip_cache
+from backend.app.utils.github_api import ensure_all_cores, close_clients as close_github_clients
 from backend.app.core.config import settings # Import settings
 
 # Configure logging
@@ -27,8 +31,7 @@ app.add_middleware(
 
 # Dependency to ensure cores are downloaded
 async def check_proxy_cores():
-    clash_ready = await get_clash_meta_binary()
-    singbox_ready = await get_singbox_binary()
+    clash_ready, singbox_ready = await ensure_all_cores()
     if not (clash_ready or singbox_ready):
         logger.warning("Neither Clash nor Singbox core could be prepared. IP testing functionality will be limited.")
     # Not raising HTTPException here as the app can still run, but testing might fail.
@@ -41,24 +44,40 @@ async def startup_event():
     # Ensure the directories for cores and temp configs exist
     os.makedirs(settings.CORES_DIR, exist_ok=True)
     os.makedirs(settings.TEMP_DIR, exist_ok=True)
+    load_ip_cache()
+    # One pooled client for all subscription downloads, shared across requests
+    app.state.http_client = httpx.AsyncClient(
+        timeout=30.0,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
     await check_proxy_cores()
     logger.info("Proxy core check complete.")
     logger.info(f"Clash core expected at: {os.path.abspath(settings.CLASH_CORE_PATH)}")
     logger.info(f"Singbox core expected at: {os.path.abspath(settings.SINGBOX_CORE_PATH)}")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Release pooled keep-alive connections held by the IP checker, the core controller and GitHub clients
+    await close_ip_checker_clients()
+    await close_controller_client()
+    await close_github_clients()
+    await app.state.http_client.aclose()
+    save_ip_cache()
+
+
+def get_http_client(request: Request) -> httpx.AsyncClient:
+    return request.app.state.http_client
 
 @app.post("/api/process-subscriptions", response_model=SubscriptionResponse)
-async def process_subs_endpoint(request: SubscriptionRequest):
+async def process_subs_endpoint(request: SubscriptionRequest, client: httpx.AsyncClient = Depends(get_http_client)):
     logger.info(f"Received request to process {len(request.urls)} subscription(s) for format: {request.output_format}")
     try:
         # Ensure cores are available before processing, or handle gracefully in process_subscriptions
         # This is a good place to re-check or rely on the startup check.
         
         # Check if at least one core is available that might be used by process_subscriptions
-        clash_exists = os.path.exists(settings.CLASH_CORE_PATH) and os.path.getsize(settings.CLASH_CORE_PATH) > 0
-        singbox_exists = os.path.exists(settings.SINGBOX_CORE_PATH) and os.path.getsize(settings.SINGBOX_CORE_PATH) > 0
-
-        if not (clash_exists or singbox_exists):
+        if not (core_available(settings.CLASH_CORE_PATH) or core_available(settings.SINGBOX_CORE_PATH)):
             logger.error("No proxy testing cores (Clash or Singbox) are available. Cannot perform IP checks.")
             # Fallback: return combined subscriptions without testing? Or error out?
             # For now, error out as the core feature is IP checking.
@@ -68,7 +87,8 @@ async def process_subs_endpoint(request: SubscriptionRequest):
 
 
         new_content = await process_subscriptions(
-            urls=[str(url) for url in request.urls], # Convert HttpUrl to str
+            urls=request.urls,
+            client=client,
             output_format=request.output_format
         )
         if "Error:" in new_content or not new_content.strip(): # Basic error check from process_subscriptions
@@ -85,6 +105,19 @@ async def process_subs_endpoint(request: SubscriptionRequest):
         logger.error(f"An unexpected error occurred: {e}", exc_info=True) # Log full traceback
         raise HTTPException(status_code=500, detail=f"An internal server error occurred: {str(e)}")
 
+@app.post("/api/check-ips", response_model=IPCheckResponse)
+async def check_ips_endpoint(request: IPCheckRequest):
+    proxies = list(dict.fromkeys(request.proxies)) # De-duplicate, keep order
+    logger.info(f"Received request to check exit country of {len(proxies)} proxies")
+    countries = await check_many(proxies)
+    results = {}
+    for proxy, country in zip(proxies, countries):
+        if isinstance(country, BaseException):
+            logger.error(f"Check for {proxy} failed: {country}")
+            country = "ER"
+        results[proxy] = country
+    return IPCheckResponse(results=results)
+
 # Serve frontend static files
 # Ensure the path to your frontend files is correct relative to where the backend is run.
 # If backend/ is the PWD, then ../frontend is correct.
@@ -106,4 +139,4 @@ if __name__ == "__main__":
     import uvicorn
     # uvicorn.run(app, host="0.0.0.0", port=8000)
     # More robust way to run for dev, matching Docker entrypoint somewhat:
-    uvicorn.run("backend.app.main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("backend.app.main:app", host="0.0.0.0", port=8000, reload=True, loop="uvloop")
\ No newline at end of file
@@ -0,0 +1,19 @@
+from pydantic import BaseModel, Field, field_validator
+from typing import Dict, List
+from backend.app.core.config import settings
+
+PROXY_SCHEMES = ("http://", "https://", "socks5://", "socks5h://")
+
+class IPCheckRequest(BaseModel):
+    proxies: List[str] = Field(..., max_length=settings.IP_CHECK_MAX_PROXIES) # e.g. "http://1.2.3.4:8080", "socks5://5.6.7.8:1080"
+
+    @field_validator("proxies")
+    @classmethod
+    def check_proxy_schemes(cls, proxies: List[str]) -> List[str]:
+        bad = [p for p in proxies if not p.startswith(PROXY_SCHEMES)]
+        if bad:
+            raise ValueError(f"Proxy URLs must start with one of {', '.join(PROXY_SCHEMES)}: {bad}")
+        return proxies
+
+class IPCheckResponse(BaseModel):
+    results: Dict[str, str] # proxy -> country code (or TO/ER/XX)
\ No newline at end of file
@@ -1,10 +1,18 @@
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, field_validator
 from typing import List, Optional
 
 class SubscriptionRequest(BaseModel):
-    urls: List[HttpUrl] # FastAPI will validate these are URLs
+    urls: List[str] # Plain strings: a scheme check is all we need, not full HttpUrl parsing
     output_format: str = "clash" # Default to clash
 
+    @field_validator("urls")
+    @classmethod
+    def check_http_urls(cls, urls: List[str]) -> List[str]:
+        bad = [u for u in urls if not u.startswith(("http://", "https://"))]
+        if bad:
+            raise ValueError(f"Subscription URLs must start with http:// or https://: {bad}")
+        return urls
+
 class SubscriptionResponse(BaseModel):
     new_subscription_content: str
     new_subscription_url: Optional[str] = None # If you decide to host the generated content temporarily
@@ -1,14 +1,29 @@
+import asyncio
 import httpx
+import io
+import orjson
 import os
 import shutil
+import stat
 import platform
+import time
 import logging
 import tarfile
-import gzip
 import zipfile
-import io
+from typing import Optional
 from backend.app.core.config import settings
 
+try: # Intel ISA-L (SIMD) inflate, a few times faster than stock zlib on the .gz/.tar.gz assets
+    from isal import igzip as gzip_lib, isal_zlib as zlib_lib
+except ImportError: # Optional: fall back to the standard library
+    import gzip as gzip_lib
+    import zlib as zlib_lib
+
+try: # Parallel gzip decompression for large archives
+    import rapidgzip
+except ImportError: # Optional
+    rapidgzip = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -22,154 +37,300 @@ if GITHUB_API_TOKEN:
 else:
     logger.warning("GITHUB_TOKEN environment variable not set. GitHub API requests may be rate-limited.")
 
+# 平台在进程生命周期内不变, 导入时检测一次
+_ARCH = platform.machine().lower()
+_SYS = platform.system().lower()
+# PROXY_GEO_FORCE_ARCH (e.g. "arm64") fetches cores for another architecture, e.g. when building images for it
+_GH_ARCH = os.environ.get("PROXY_GEO_FORCE_ARCH") or {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "armv7"}.get(_ARCH, _ARCH)
+# Architectures both cores publish release assets for
+SUPPORTED_GH_ARCH = {"amd64", "arm64", "armv7"}
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20 # 1 MiB
+# Archives above this size are inflated with rapidgzip on hosts with 4+ cores
+PARALLEL_GUNZIP_MIN_SIZE = 50 << 20 # 50 MiB
+# Release assets published next to the binaries that are never binaries themselves (signatures, checksums, keys)
+SKIPPED_ASSET_EXTS = (".sig", ".asc", ".sha256", ".sha256sum", ".txt", ".pem", ".pub")
+
+# 所有 GitHub 请求 (API 元数据和资源下载) 共用一个连接池, 两个核心的请求可以复用已建立的 TLS 连接
+_client: Optional[httpx.AsyncClient] = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            timeout=120.0, # 下载大文件需要较长超时
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=1000),
+        )
+    return _client
+
+async def close_clients():
+    """Closes the shared GitHub client. Called on application shutdown."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+def _preallocate(f, response: httpx.Response):
+    """Reserves the file's final size up front, so the filesystem allocates it once instead of growing it per write."""
+    size = response.headers.get("Content-Length")
+    # With a Content-Encoding the decoded body is larger than Content-Length
+    if not size or "Content-Encoding" in response.headers or not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, int(size))
+    except (OSError, ValueError): # e.g. unsupported by the filesystem
+        pass
+
 async def download_file(url: str, dest_path: str):
-    # 下载 GitHub Release 的 'browser_download_url' 通常不需要认证
+    # 下载 GitHub Release 的 'browser_download_url' 通常不需要认证, 所以这里不带 COMMON_HEADERS
     # Token 主要用于 api.github.com 的元数据请求
-    async with httpx.AsyncClient(follow_redirects=True, timeout=120.0) as client: # 增加超时时间
-        try:
-            logger.info(f"Attempting to download asset from: {url}")
-            response = await client.get(url)
+    client = _get_client()
+    try:
+        logger.info(f"Attempting to download asset from: {url}")
+        # Stream to disk in chunks instead of holding the whole asset in memory
+        async with client.stream("GET", url) as response:
             response.raise_for_status() # Raises an exception for 4XX/5XX errors
-            
-            # If it's a GZ file, decompress it directly
+
+            # If it's a GZ file, decompress it on the fly while it downloads
             if url.endswith(".gz") and not url.endswith(".tar.gz"):
                 logger.info(f"Decompressing GZ file to {dest_path}")
-                with gzip.open(io.BytesIO(response.content), 'rb') as f_in:
-                    with open(dest_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-            elif url.endswith(".zip"):
-                logger.info(f"Decompressing ZIP file to {os.path.dirname(dest_path)}")
-                with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
-                    # Find the executable within the zip. This logic might need adjustment based on zip structure.
-                    # Assuming the main executable is often named similar to the repo or is the largest file.
-                    # For simplicity, we'll extract all and assume the caller knows the executable name.
-                    zf.extractall(os.path.dirname(dest_path))
-                    # Potentially rename the main executable if needed, or ensure the core_path points to it.
-                    # This part is tricky as zip contents vary.
-                    # Example: if sing-box executable is inside a folder in the zip.
-                    # For now, this just extracts. The caller (ensure_core_binary) will need to find the correct binary.
-            else: # For tar.gz or direct binary
-                with open(dest_path, 'wb') as f:
-                    f.write(response.content)
-            
-            # Make executable if it's a binary (not a compressed archive itself)
-            # if not url.endswith((".gz", ".zip", ".tar.gz")): # or after decompression
-            #      os.chmod(dest_path, 0o755)
-            logger.info(f"Successfully downloaded/extracted to {dest_path}")
-            return True
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error downloading {url}: {e.response.status_code} - {e.response.text}")
-        except Exception as e:
-            logger.error(f"Failed to download {url}: {e}")
-    return False
+                decompressor = zlib_lib.decompressobj(wbits=31) # 31: expect a gzip header
+            else: # tar.gz / zip are extracted by ensure_core_binary, direct binaries used as-is
+                decompressor = None
+            # Disk writes (and inflating) happen in a worker thread so the event loop keeps serving
+            # the other core's download in the meantime
+            def write_chunk(chunk: bytes):
+                f.write(decompressor.decompress(chunk) if decompressor else chunk)
 
-def find_executable_in_dir(dir_path, possible_names):
-    for root, _, files in os.walk(dir_path):
-        for f_name in files:
-            if f_name in possible_names:
-                return os.path.join(root, f_name)
-    return None
+            f = await asyncio.to_thread(open, dest_path, 'wb')
+            try:
+                if decompressor is None:
+                    await asyncio.to_thread(_preallocate, f, response)
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(write_chunk, chunk)
+                if decompressor:
+                    await asyncio.to_thread(f.write, decompressor.flush())
+                await asyncio.to_thread(f.truncate) # Drop any preallocated space that wasn't written
+            finally:
+                await asyncio.to_thread(f.close)
 
+        # Make executable if it's a binary (not a compressed archive itself)
+        # if not url.endswith((".gz", ".zip", ".tar.gz")): # or after decompression
+        #      os.chmod(dest_path, 0o755)
+        logger.info(f"Successfully downloaded/extracted to {dest_path}")
+        return True
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error downloading {url}: {e.response.status_code} - {e.response.reason_phrase}")
+    except Exception as e:
+        logger.error(f"Failed to download {url}: {e}")
+    # Don't leave a partial file behind, which may also be preallocated to the full size
+    await asyncio.to_thread(_discard, dest_path)
+    return False
 
-async def ensure_core_binary(core_name: str, github_api_url: str, target_binary_path: str, asset_keyword: str, executable_name_in_archive: str):
-    if os.path.exists(target_binary_path) and os.path.getsize(target_binary_path) > 0:
-        logger.info(f"{core_name} binary already exists at {target_binary_path}")
-        try:
-            os.chmod(target_binary_path, 0o755) # 确保可执行
-        except Exception:
-            pass
+class _SyncStream(io.RawIOBase):
+    """
+    Blocking, read-only file view of an async byte iterator, for code running in a
+    worker thread (asyncio.to_thread): each read waits on the event loop for the next chunk.
+    """
+    def __init__(self, chunks, loop: asyncio.AbstractEventLoop):
+        self._chunks = chunks
+        self._loop = loop
+        self._pending = memoryview(b"")
+        self._eof = False
+
+    def readable(self):
         return True
 
-    logger.info(f"Requesting latest {core_name} release info from {github_api_url} using configured headers.")
-    # !!! 关键改动: 在 httpx.AsyncClient 中传入 headers=COMMON_HEADERS !!!
-    async with httpx.AsyncClient(headers=COMMON_HEADERS, timeout=30.0, follow_redirects=True) as client:
+    async def _next_chunk(self) -> bytes:
         try:
-            response = await client.get(github_api_url)
-            response.raise_for_status() # 对 4xx/5xx 错误抛出异常
-            latest_release = response.json()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error getting {core_name} release info ({github_api_url}): {e.response.status_code} - {e.response.text}", exc_info=True)
-            return False
-        except Exception as e:
-            logger.error(f"Failed to get {core_name} release info ({github_api_url}): {e}", exc_info=True)
-            return False
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
 
-    assets = latest_release.get("assets", [])
-    arch = platform.machine().lower()
-    sys_platform = platform.system().lower()
+    def readinto(self, b) -> int:
+        while not self._pending and not self._eof:
+            chunk = asyncio.run_coroutine_threadsafe(self._next_chunk(), self._loop).result()
+            self._eof = not chunk
+            self._pending = memoryview(chunk)
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
 
-    if arch == "x86_64": gh_arch = "amd64"
-    elif arch == "aarch64": gh_arch = "arm64"
-    elif arch == "armv7l": gh_arch = "armv7"
-    else: gh_arch = arch
+def _use_rapidgzip(size: int) -> bool:
+    return rapidgzip is not None and (os.cpu_count() or 1) >= 4 and size > PARALLEL_GUNZIP_MIN_SIZE
 
-    dl_url = None
-    found_asset_name = None
+def _open_gzip(path: str):
+    """Opens a gzip file for reading, inflating it on all cores if it is large enough to be worth it."""
+    if _use_rapidgzip(os.path.getsize(path)):
+        cpus = os.cpu_count()
+        logger.info(f"Decompressing {path} with rapidgzip on {cpus} threads")
+        return rapidgzip.open(path, parallelization=cpus)
+    return gzip_lib.open(path, 'rb')
 
-    for asset in assets:
-        name = asset.get("name", "").lower()
-        # 你原有的 asset 筛选逻辑
-        if asset_keyword in name and gh_arch in name and sys_platform in name:
-            dl_url = asset.get("browser_download_url")
-            found_asset_name = name
-            logger.info(f"Found matching asset for {core_name}: {name} for {sys_platform}-{gh_arch}")
-            break
+def _install_binary(src, target_binary_path: str):
+    """Copies an archive member's content to target_binary_path."""
+    # Write beside the target and rename over it: a running core's binary can't be opened for writing
+    part_path = f"{target_binary_path}.part"
+    try:
+        with open(part_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+        os.replace(part_path, target_binary_path)
+    except BaseException:
+        _discard(part_path) # Don't leave a half-written binary in the cores directory
+        raise
 
-    if not dl_url:
-        logger.warning(f"Could not find a suitable {core_name} asset for {sys_platform}-{gh_arch} with keyword '{asset_keyword}'. Available assets:")
-        for asset in assets: logger.warning(f" - {asset.get('name')}")
-        return False
+def _discard(path: str):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
 
-    download_dir = os.path.dirname(target_binary_path) # e.g., /app/backend/downloaded_cores
-    os.makedirs(download_dir, exist_ok=True)
+def _fast_move(src: str, dst: str):
+    """
+    Moves src over dst: a rename when both are on one filesystem, otherwise an
+    in-kernel sendfile() copy (no read/write through Python buffers) and unlink.
+    """
+    try:
+        os.replace(src, dst)
+        return
+    except OSError: # e.g. EXDEV: different filesystems
+        pass
+    part_path = f"{dst}.part" # see _install_binary
+    try:
+        with open(src, 'rb') as fin, open(part_path, 'wb') as fout:
+            if hasattr(os, "sendfile"):
+                size = os.fstat(fin.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(fout.fileno(), fin.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            else:
+                shutil.copyfileobj(fin, fout, DOWNLOAD_CHUNK_SIZE)
+        os.replace(part_path, dst)
+    except BaseException:
+        _discard(part_path)
+        raise
+    os.unlink(src)
 
-    # 临时下载路径，使用 GitHub 上的资源名
-    temp_download_path = os.path.join(download_dir, found_asset_name) 
+def _extract_tar_member(fileobj, wanted_names, target_binary_path: str) -> bool:
+    """
+    Installs the first executable named in wanted_names from an (already decompressed)
+    tar stream at target_binary_path. Returns False if there is none.
+    """
+    # Stream mode ("r|") reads the archive front to back one member at a time, so we can stop at the binary
+    # instead of decompressing LICENSE, README etc. as well
+    with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+        for member in tar:
+            if member.isfile() and os.path.basename(member.name) in wanted_names:
+                with tar.extractfile(member) as src:
+                    _install_binary(src, target_binary_path)
+                return True
+    return False
+
+async def _stream_install_tar_gz(url: str, target_binary_path: str, wanted_names) -> bool:
+    """
+    Downloads a .tar.gz and installs its executable (see _extract_tar_member) while the
+    bytes arrive, so the archive itself is never written to disk and inflating overlaps
+    the download. Returns False if the download failed or held no such executable.
+    """
+    client = _get_client()
+    try:
+        logger.info(f"Streaming and extracting asset from: {url}")
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            raw = _SyncStream(response.aiter_bytes(DOWNLOAD_CHUNK_SIZE), asyncio.get_running_loop())
+
+            def extract() -> bool:
+                with gzip_lib.open(io.BufferedReader(raw, DOWNLOAD_CHUNK_SIZE), 'rb') as gz:
+                    return _extract_tar_member(gz, wanted_names, target_binary_path)
 
-    logger.info(f"Downloading asset {found_asset_name} for {core_name} from {dl_url}")
-    if not await download_file(dl_url, temp_download_path):
-        logger.error(f"Failed to download asset for {core_name} from {dl_url}.")
+            if await asyncio.to_thread(extract):
+                return True
+        logger.error(f"No executable named any of {sorted(wanted_names)} found in {url}")
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error downloading {url}: {e.response.status_code} - {e.response.reason_phrase}")
+    except Exception as e:
+        logger.error(f"Failed to download and extract {url}: {e}")
+    return False
+
+def _update_check_due(release_path: str) -> bool:
+    """True if an existing core should be checked against GitHub again (see CORE_UPDATE_CHECK_INTERVAL)."""
+    if settings.CORE_UPDATE_CHECK_INTERVAL <= 0:
         return False
+    try:
+        # The sidecar's mtime is the time of the last check
+        return time.time() - os.path.getmtime(release_path) >= settings.CORE_UPDATE_CHECK_INTERVAL
+    except OSError: # Never checked
+        return True
 
-    # --- 核心的解压、重命名、权限设置逻辑 ---
+def _read_release_info(release_path: str) -> dict:
+    """{"id": release id, "etag": API response ETag} of the release the current core came from, {} if unknown."""
+    try:
+        with open(release_path, 'rb') as f:
+            info = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return info if isinstance(info, dict) else {}
+
+def _write_release_info(release_path: str, release_id, etag: str):
+    try:
+        with open(release_path, 'wb') as f:
+            f.write(orjson.dumps({"id": release_id, "etag": etag}))
+    except OSError as e:
+        logger.warning(f"Could not write {release_path}: {e}")
+
+def _ensure_executable(path: str, st: os.stat_result):
+    """Makes an existing core binary executable, unless its mode (from st) already is 0755."""
+    if stat.S_IMODE(st.st_mode) != 0o755:
+        try:
+            os.chmod(path, 0o755) # 确保可执行
+        except Exception:
+            pass
+
+def _install_downloaded_asset(core_name: str, found_asset_name: str, temp_download_path: str,
+                              target_binary_path: str, wanted_names) -> bool:
+    """
+    Blocking half of ensure_core_binary: turns the downloaded asset into the
+    binary at target_binary_path and removes the download.
+    Returns False if an archive held no executable named in wanted_names.
+    """
     # 这部分需要非常健壮，确保最终 `target_binary_path` 是正确的、可执行的二进制文件
     final_executable_path_after_processing = None
 
+    # Archives: copy just the executable member straight to its final place, no temp extraction dir
     if found_asset_name.endswith(".tar.gz"):
+        # Only large archives get here, for rapidgzip (see ensure_core_binary); the rest are streamed
         logger.info(f"Extracting {temp_download_path}...")
-        extract_to_dir = os.path.join(download_dir, f"{core_name}_extracted") # 临时解压目录
-        os.makedirs(extract_to_dir, exist_ok=True)
-        with tarfile.open(temp_download_path, "r:gz") as tar:
-            tar.extractall(path=extract_to_dir)
-        final_executable_path_after_processing = find_executable_in_dir(extract_to_dir, [executable_name_in_archive, core_name])
-        if final_executable_path_after_processing and final_executable_path_after_processing != target_binary_path:
-             shutil.move(final_executable_path_after_processing, target_binary_path)
-        if os.path.exists(extract_to_dir): # 清理临时解压目录
-            shutil.rmtree(extract_to_dir)
+        with _open_gzip(temp_download_path) as gz:
+            if _extract_tar_member(gz, wanted_names, target_binary_path):
+                final_executable_path_after_processing = target_binary_path
 
     elif found_asset_name.endswith(".gz"): # 例如 clash.meta-linux-amd64-vX.Y.Z.gz
         # download_file 已经解压到 temp_download_path (原名)
         # 我们需要将它移动/重命名到 target_binary_path
         if temp_download_path != target_binary_path:
-            shutil.move(temp_download_path, target_binary_path)
+            _fast_move(temp_download_path, target_binary_path)
         else: # 如果 temp_download_path 就是 target_binary_path (不太可能，因为名字不同)
             pass 
         final_executable_path_after_processing = target_binary_path
 
     elif found_asset_name.endswith(".zip"):
         logger.info(f"Extracting {temp_download_path}...")
-        extract_to_dir = os.path.join(download_dir, f"{core_name}_extracted_zip")
-        os.makedirs(extract_to_dir, exist_ok=True)
         with zipfile.ZipFile(temp_download_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_to_dir)
-        final_executable_path_after_processing = find_executable_in_dir(extract_to_dir, [executable_name_in_archive, core_name])
-        if final_executable_path_after_processing and final_executable_path_after_processing != target_binary_path:
-             shutil.move(final_executable_path_after_processing, target_binary_path)
-        if os.path.exists(extract_to_dir):
-            shutil.rmtree(extract_to_dir)
+            for info in zip_ref.infolist():
+                if not info.is_dir() and os.path.basename(info.filename) in wanted_names:
+                    with zip_ref.open(info) as src:
+                        _install_binary(src, target_binary_path)
+                    final_executable_path_after_processing = target_binary_path
+                    break
     else: # 直接是二进制文件
         if temp_download_path != target_binary_path:
-            shutil.move(temp_download_path, target_binary_path)
+            _fast_move(temp_download_path, target_binary_path)
         final_executable_path_after_processing = target_binary_path
 
     # 清理下载的原始压缩包 (如果它不是最终目标文件)
@@ -182,11 +343,118 @@ async def ensure_core_binary(core_name: str, github_api_url: str, target_binary_
         except Exception as e:
             logger.warning(f"Could not clean up downloaded archive {temp_download_path}: {e}")
 
+    return final_executable_path_after_processing is not None
+
+async def ensure_core_binary(core_name: str, github_api_url: str, target_binary_path: str, asset_keyword: str, executable_name_in_archive: str):
+    # Sidecar recording which release the current binary came from (see _read_release_info)
+    release_path = f"{target_binary_path}.release"
+    try: # One stat answers exists / is a file / non-empty / mode
+        st = os.stat(target_binary_path)
+    except OSError:
+        st = None
+    have_binary = st is not None and stat.S_ISREG(st.st_mode) and st.st_size > 0
+    if have_binary and not _update_check_due(release_path):
+        logger.info(f"{core_name} binary already exists at {target_binary_path}")
+        _ensure_executable(target_binary_path, st)
+        return True
+
+    # 不支持的架构不可能匹配到资源, 不必浪费一次 API 请求 (计入速率限制)
+    if _GH_ARCH not in SUPPORTED_GH_ARCH:
+        logger.error(f"No {core_name} release assets for architecture '{_GH_ARCH}' (machine '{_ARCH}'). Supported: {sorted(SUPPORTED_GH_ARCH)}; set PROXY_GEO_FORCE_ARCH to override.")
+        return have_binary
+
+    headers = COMMON_HEADERS
+    installed_release = _read_release_info(release_path) if have_binary else {}
+    if installed_release.get("etag"):
+        # Bonus only: the JSON embeds download counts, so the ETag changes even when the release doesn't
+        headers = {**COMMON_HEADERS, "If-None-Match": installed_release["etag"]}
+
+    logger.info(f"Requesting latest {core_name} release info from {github_api_url} using configured headers.")
+    # !!! 关键改动: API 请求带上 headers=COMMON_HEADERS (Token) !!!
+    try:
+        response = await _get_client().get(github_api_url, headers=headers, timeout=30.0)
+        if response.status_code == 304: # 304 doesn't count against the API rate limit
+            logger.info(f"{core_name} binary at {target_binary_path} is up to date")
+            _ensure_executable(target_binary_path, st)
+            os.utime(release_path)
+            return True
+        response.raise_for_status() # 对 4xx/5xx 错误抛出异常
+        latest_release = orjson.loads(response.content) # Release JSON lists every asset; orjson parses it several times faster
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error getting {core_name} release info ({github_api_url}): {e.response.status_code} - {e.response.text}", exc_info=True)
+        return have_binary # An update check failing still leaves a usable core
+    except Exception as e:
+        logger.error(f"Failed to get {core_name} release info ({github_api_url}): {e}", exc_info=True)
+        return have_binary
+    release_etag = response.headers.get("ETag", "")
+    release_id = latest_release.get("id")
+
+    # 已经是最新版本 (同一个 release), 不必重新下载
+    if have_binary and release_id is not None and release_id == installed_release.get("id"):
+        logger.info(f"{core_name} binary at {target_binary_path} is already from the latest release ({latest_release.get('tag_name')})")
+        _ensure_executable(target_binary_path, st)
+        await asyncio.to_thread(_write_release_info, release_path, release_id, release_etag)
+        return True
+
+    assets = latest_release.get("assets", [])
+    sys_platform = _SYS
+    gh_arch = _GH_ARCH
+
+    dl_url = None
+    found_asset_name = None
+
+    wanted_fragments = (asset_keyword.lower(), gh_arch.lower(), sys_platform.lower())
+    for asset in assets:
+        name = asset.get("name", "").lower()
+        # 跳过签名/校验文件, 例如 sing-box-linux-arm64.tar.gz.sha256 也包含全部关键字
+        if name.endswith(SKIPPED_ASSET_EXTS):
+            continue
+        # 你原有的 asset 筛选逻辑
+        if all(fragment in name for fragment in wanted_fragments):
+            dl_url = asset.get("browser_download_url")
+            found_asset_name = name
+            asset_size = asset.get("size", 0)
+            logger.info(f"Found matching asset for {core_name}: {name} for {sys_platform}-{gh_arch}")
+            break
+
+    if not dl_url:
+        logger.warning(f"Could not find a suitable {core_name} asset for {sys_platform}-{gh_arch} with keyword '{asset_keyword}'. Available assets:")
+        for asset in assets: logger.warning(f" - {asset.get('name')}")
+        return have_binary
+
+    download_dir = os.path.dirname(target_binary_path) # e.g., /app/backend/downloaded_cores
+    os.makedirs(download_dir, exist_ok=True)
+    wanted_names = {executable_name_in_archive, core_name}
+
+    if found_asset_name.endswith(".tar.gz") and not _use_rapidgzip(asset_size):
+        # Untar straight from the network; rapidgzip needs the whole file, so large archives still go to disk first
+        logger.info(f"Downloading and extracting asset {found_asset_name} for {core_name} from {dl_url}")
+        if not await _stream_install_tar_gz(dl_url, target_binary_path, wanted_names):
+            logger.error(f"Failed to install {core_name} from {found_asset_name}.")
+            return have_binary
+    else:
+        # 临时下载路径，使用 GitHub 上的资源名 (zip 需要随机访问, 只能先落盘)
+        temp_download_path = os.path.join(download_dir, found_asset_name) 
+
+        logger.info(f"Downloading asset {found_asset_name} for {core_name} from {dl_url}")
+        if not await download_file(dl_url, temp_download_path):
+            logger.error(f"Failed to download asset for {core_name} from {dl_url}.")
+            return have_binary
+
+        # --- 核心的解压、重命名、权限设置逻辑 ---
+        # All blocking disk work, so it runs in a worker thread instead of stalling the other core's download
+        installed = await asyncio.to_thread(_install_downloaded_asset, core_name, found_asset_name, temp_download_path,
+                                            target_binary_path, wanted_names)
+        if not installed:
+            logger.error(f"No {executable_name_in_archive} executable found in {found_asset_name} for {core_name}.")
+            return have_binary
+
     # 确认最终文件存在并且设置权限
-    if os.path.exists(target_binary_path) and os.path.isfile(target_binary_path):
+    if os.path.isfile(target_binary_path):
         try:
-            os.chmod(target_binary_path, 0o755)
+            await asyncio.to_thread(os.chmod, target_binary_path, 0o755)
             logger.info(f"{core_name} binary successfully prepared at {target_binary_path}")
+            await asyncio.to_thread(_write_release_info, release_path, release_id, release_etag)
             return True
         except Exception as e:
             logger.error(f"Failed to set executable permission on {target_binary_path}: {e}", exc_info=True)
@@ -212,7 +480,37 @@ async def get_singbox_binary():
         asset_keyword="sing-box", # 根据实际情况调整
         executable_name_in_archive="sing-box" # 解压后二进制文件的确切名称
     )
-# Example usage (typically called at application startup)
-# import asyncio
-# asyncio.run(get_clash_meta_binary())
-# asyncio.run(get_singbox_binary())
+
+async def ensure_all_cores():
+    """
+    Prepares both cores concurrently; they are independent, so one can download
+    while the other waits on the network. Returns (clash_ready, singbox_ready).
+    """
+    results = await asyncio.gather(get_clash_meta_binary(), get_singbox_binary(), return_exceptions=True)
+    ready = []
+    for core_name, result in zip(("Mihomo", "Sing-box"), results):
+        if isinstance(result, BaseException):
+            logger.error(f"Preparing {core_name} failed: {result}", exc_info=result)
+            result = False
+        ready.append(result)
+    return tuple(ready)
+
+
+if __name__ == "__main__":
+    # Prefetch the cores without starting the app (e.g. as a build step):
+    #   python -m backend.app.utils.github_api
+    # The app itself calls ensure_all_cores() at startup and runs under uvloop via uvicorn.
+    try:
+        import uvloop # libuv-based event loop, shipped with uvicorn[standard]
+        uvloop.install()
+    except ImportError:
+        pass
+
+    async def _prefetch():
+        try:
+            return await ensure_all_cores()
+        finally:
+            await close_clients()
+
+    clash_ready, singbox_ready = asyncio.run(_prefetch())
+    raise SystemExit(0 if clash_ready or singbox_ready else 1)
@@ -0,0 +1,151 @@
+import dataclasses
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+
+from backend.app.utils import github_api
+
+# Incompressible, so the archive spans many stream chunks
+PAYLOAD = os.urandom(3 << 20)
+
+def make_tar_gz() -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for name, data in (("pkg/LICENSE", b"license"), ("pkg/mihomo", PAYLOAD)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+ARCHIVE = make_tar_gz()
+
+
+class StreamInstallTarGzTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.target = os.path.join(self.tmp.name, "mihomo")
+
+    async def asyncTearDown(self):
+        await github_api.close_clients()
+        self.tmp.cleanup()
+
+    def use_transport(self, handler):
+        github_api._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def test_installs_member_from_stream(self):
+        self.use_transport(lambda request: httpx.Response(200, content=ARCHIVE))
+        ok = await github_api._stream_install_tar_gz("http://dl/core.tar.gz", self.target, {"mihomo"})
+        self.assertTrue(ok)
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertEqual(os.listdir(self.tmp.name), ["mihomo"])
+
+    async def test_missing_member(self):
+        self.use_transport(lambda request: httpx.Response(200, content=ARCHIVE))
+        ok = await github_api._stream_install_tar_gz("http://dl/core.tar.gz", self.target, {"sing-box"})
+        self.assertFalse(ok)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    async def test_broken_download_leaves_no_part_file(self):
+        async def truncated():
+            yield ARCHIVE[:len(ARCHIVE) // 2]
+            raise httpx.ReadError("connection lost")
+
+        self.use_transport(lambda request: httpx.Response(200, content=truncated()))
+        ok = await github_api._stream_install_tar_gz("http://dl/core.tar.gz", self.target, {"mihomo"})
+        self.assertFalse(ok)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    async def test_http_error(self):
+        self.use_transport(lambda request: httpx.Response(404))
+        ok = await github_api._stream_install_tar_gz("http://dl/core.tar.gz", self.target, {"mihomo"})
+        self.assertFalse(ok)
+
+
+class DownloadFileTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp.name, "core.zip")
+
+    async def asyncTearDown(self):
+        await github_api.close_clients()
+        self.tmp.cleanup()
+
+    async def test_broken_download_leaves_no_file(self):
+        async def truncated():
+            yield b"\0" * (1 << 20)
+            raise httpx.ReadError("connection lost")
+
+        # Content-Length makes download_file preallocate the full 40 MiB up front
+        github_api._client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, content=truncated(), headers={"Content-Length": str(40 << 20)})))
+        self.assertFalse(await github_api.download_file("http://dl/core.zip", self.dest))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    async def test_download(self):
+        github_api._client = httpx.AsyncClient(transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, content=PAYLOAD)))
+        self.assertTrue(await github_api.download_file("http://dl/core.zip", self.dest))
+        with open(self.dest, "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+
+
+class ReleaseCheckTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.target = os.path.join(self.tmp.name, "mihomo")
+        with open(self.target, "wb") as f:
+            f.write(b"old core")
+        os.chmod(self.target, 0o755)
+        self.requests = []
+        self.asset_name = f"mihomo-{github_api._SYS}-{github_api._GH_ARCH}.tar.gz"
+        due = dataclasses.replace(github_api.settings, CORE_UPDATE_CHECK_INTERVAL=1)
+        patcher = mock.patch.object(github_api, "settings", due)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        github_api._client = httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+    async def asyncTearDown(self):
+        await github_api.close_clients()
+        self.tmp.cleanup()
+
+    def handle(self, request):
+        self.requests.append(request)
+        if request.url.host == "api":
+            # A new ETag every time, as download counts in the JSON keep changing
+            release = {"id": 42, "tag_name": "v1", "assets": [
+                {"name": self.asset_name, "browser_download_url": f"http://dl/{self.asset_name}", "size": len(ARCHIVE)}]}
+            return httpx.Response(200, json=release, headers={"ETag": f'"{len(self.requests)}"'})
+        return httpx.Response(200, content=ARCHIVE)
+
+    def write_release_info(self, release_id):
+        github_api._write_release_info(f"{self.target}.release", release_id, '"0"')
+        os.utime(f"{self.target}.release", (0, 0)) # Checked long ago
+
+    async def ensure(self):
+        return await github_api.ensure_core_binary("mihomo", "http://api/releases/latest", self.target, "mihomo", "mihomo")
+
+    async def test_same_release_is_not_downloaded_again(self):
+        self.write_release_info(42)
+        self.assertTrue(await self.ensure())
+        self.assertEqual([r.url.host for r in self.requests], ["api"])
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), b"old core")
+        self.assertEqual(github_api._read_release_info(f"{self.target}.release")["etag"], '"1"')
+
+    async def test_new_release_is_downloaded(self):
+        self.write_release_info(41)
+        self.assertTrue(await self.ensure())
+        self.assertEqual([r.url.host for r in self.requests], ["api", "dl"])
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), PAYLOAD)
+        self.assertEqual(github_api._read_release_info(f"{self.target}.release")["id"], 42)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import asyncio
+import dataclasses
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from backend.app.core import proxy_manager, sub_converter
+
+
+def make_nodes(count, node_type="ss"):
+    # Display names repeat on purpose: only _test_tag has to be unique
+    return [{"name": "same name", "type": node_type, "server": "example.com", "port": 1000 + i,
+             "_test_tag": f"node-{i}", "_source_format": "clash_dict"} for i in range(count)]
+
+
+def reset_port_pool():
+    # The pool's Queue and Lock belong to the loop they were first used in
+    proxy_manager._free_ports = None
+    proxy_manager._port_lock = None
+
+
+class WriteTestConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.nodes = make_nodes(5)
+        self.lane_ports = [20001, 20002, 20003]
+
+    def write(self, use_clash):
+        path = os.path.join(self.tmp.name, "config.yaml" if use_clash else "config.json")
+        sub_converter._write_test_config(self.nodes, use_clash, path, self.lane_ports, 20000)
+        with open(path, encoding="utf-8") as f:
+            return yaml.safe_load(f) if use_clash else json.load(f)
+
+    def test_clash(self):
+        config = self.write(use_clash=True)
+        tags = [f"node-{i}" for i in range(5)]
+        self.assertEqual([p["name"] for p in config["proxies"]], tags)
+        self.assertFalse(any(k.startswith("_") for p in config["proxies"] for k in p))
+        self.assertEqual([(l["port"], l["proxy"]) for l in config["listeners"]],
+                         [(20001, "LANE-0"), (20002, "LANE-1"), (20003, "LANE-2")])
+        self.assertTrue(all(l["listen"] == "127.0.0.1" for l in config["listeners"]))
+        self.assertEqual([(g["name"], g["type"], g["proxies"]) for g in config["proxy-groups"]],
+                         [(f"LANE-{k}", "select", tags) for k in range(3)])
+        self.assertEqual(config["rules"], ["MATCH,REJECT"])
+        self.assertEqual(config["external-controller"], "127.0.0.1:20000")
+
+    def test_singbox(self):
+        config = self.write(use_clash=False)
+        tags = [f"node-{i}" for i in range(5)]
+        outbound_tags = [o["tag"] for o in config["outbounds"]]
+        self.assertEqual(len(outbound_tags), len(set(outbound_tags)))
+        self.assertEqual(outbound_tags[:5], tags)
+        selectors = {o["tag"]: o["outbounds"] for o in config["outbounds"] if o["type"] == "selector"}
+        self.assertEqual(selectors, {f"LANE-{k}": tags for k in range(3)})
+        inbounds = {i["tag"]: i["listen_port"] for i in config["inbounds"]}
+        self.assertEqual(inbounds, {"lane-0": 20001, "lane-1": 20002, "lane-2": 20003})
+        routes = {r["inbound"][0]: r["outbound"] for r in config["route"]["rules"]}
+        self.assertEqual(routes, {"lane-0": "LANE-0", "lane-1": "LANE-1", "lane-2": "LANE-2"})
+        self.assertEqual(config["experimental"]["clash_api"]["external_controller"], "127.0.0.1:20000")
+
+
+class PortPoolTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        reset_port_pool()
+        self.addCleanup(reset_port_pool)
+        small_pool = dataclasses.replace(proxy_manager.settings, TEST_PORT_BASE=30000, TEST_PORT_POOL_SIZE=4)
+        patcher = mock.patch.object(proxy_manager, "settings", small_pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_concurrent_takers_never_share_ports(self):
+        held = set()
+
+        async def taker():
+            ports = await proxy_manager.acquire_ports(3)
+            self.assertEqual(len(ports), 3)
+            self.assertFalse(held & set(ports))
+            held.update(ports)
+            await asyncio.sleep(0.01)
+            held.difference_update(ports)
+            proxy_manager.release_ports(ports)
+
+        # 3 takers of 3 ports from a pool of 4: they have to take turns
+        await asyncio.wait_for(asyncio.gather(*(taker() for _ in range(3))), timeout=5)
+        self.assertEqual(proxy_manager._free_ports.qsize(), 4)
+
+    async def test_cancelled_taker_returns_ports(self):
+        first = await proxy_manager.acquire_ports(3)
+        waiting = asyncio.ensure_future(proxy_manager.acquire_ports(3))
+        await asyncio.sleep(0.01) # Holds the last free port, waiting for more
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        proxy_manager.release_ports(first)
+        self.assertEqual(proxy_manager._free_ports.qsize(), 4)
+
+    async def test_more_than_pool(self):
+        with self.assertRaises(ValueError):
+            await proxy_manager.acquire_ports(5)
+
+
+class FakeProcess:
+    pid = 0
+
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+
+class BisectionTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        reset_port_pool()
+        self.addCleanup(reset_port_pool)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.started = []
+        settings = dataclasses.replace(sub_converter.settings, TEMP_DIR=self.tmp.name, TEST_CONCURRENCY=4)
+        for name, value in (("settings", settings), ("run_proxy_core", self.fake_run_proxy_core),
+                            ("stop_proxy_core", self.fake_stop_proxy_core), ("set_active_proxy", self.fake_set_active_proxy),
+                            ("close_connections", self.fake_close_connections), ("get_exit_ip", self.fake_get_exit_ip)):
+            patcher = mock.patch.object(sub_converter, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def fake_run_proxy_core(self, core_path, config_path, core_type, ready_ports=()):
+        with open(config_path, encoding="utf-8") as f:
+            config = yaml.safe_load(f) if core_type == "clash" else json.load(f)
+        entries = config["proxies"] if core_type == "clash" else config["outbounds"]
+        self.started.append(len(ready_ports))
+        # Like a real core, refuse the whole config if any node in it is malformed
+        return FakeProcess(1 if any(e.get("malformed") for e in entries) else None)
+
+    async def fake_stop_proxy_core(self, process, core_type):
+        pass
+
+    async def fake_set_active_proxy(self, controller_port, name, group="GLOBAL"):
+        pass
+
+    async def fake_close_connections(self, controller_port, group=None):
+        pass
+
+    async def fake_get_exit_ip(self, proxy_address, client=None):
+        return "203.0.113.1", None
+
+    async def check(self, use_clash):
+        nodes = make_nodes(9, "ss" if use_clash else "hysteria2")
+        nodes[6]["malformed"] = True
+        await sub_converter._test_nodes_on_core(nodes, use_clash)
+        self.assertEqual(nodes[6].get("_country"), "FL")
+        self.assertNotIn("_exit_ip", nodes[6])
+        for node in nodes[:6] + nodes[7:]:
+            self.assertEqual(node.get("_exit_ip"), "203.0.113.1")
+            self.assertNotIn("_country", node)
+        self.assertGreater(len(self.started), 1)
+        self.assertEqual(proxy_manager._free_ports.qsize(), proxy_manager.settings.TEST_PORT_POOL_SIZE)
+        self.assertEqual(os.listdir(self.tmp.name), []) # Temp configs removed
+
+    async def test_clash(self):
+        await self.check(use_clash=True)
+
+    async def test_singbox(self):
+        await self.check(use_clash=False)
+
+
+if __name__ == "__main__":
+    unittest.main()